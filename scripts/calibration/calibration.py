@@ -1,16 +1,21 @@
 
 import kubios
+import artifacts
 import boto3
 import botocore
+import coherence
 from colorama import init
 init(autoreset=True)
+import csv
 import gspread
-import h5py
+import hrv
 import json
 import moment
 from oauth2client.service_account import ServiceAccountCredentials
 from pathlib import Path
 import requests
+import results
+import spectrum
 import sys
 import tempfile
 import traceback
@@ -101,56 +106,57 @@ def extract_kubios_data(kubios_data_file):
     """Pulls relevant output from kubios_data_file and returns a tuple of two objects: 
     Settings and outuput data"""
     kubios_data = {}
-    kubios_settings = kubios.get_settings(kubios_data_file)
-    with h5py.File(kubios_data_file) as file:
-        kubios_data['hr_max'] = file['Res']['HRV']['Statistics']['max_HR'][()][0][0]
-        kubios_data['hr_min'] = file['Res']['HRV']['Statistics']['min_HR'][()][0][0]
-        kubios_data['hr_mean'] = file['Res']['HRV']['Statistics']['mean_HR'][()][0][0]
-        kubios_data['rmssd'] = 1000 * file['Res']['HRV']['Statistics']['RMSSD'][()][0][0] # multiply by 1000 to get it in ms
-        kubios_data['ar_abs_lf_power'] = file['Res']['HRV']['Frequency']['AR']['LF_power'][()][0][0]
-        kubios_data['ar_peak_lf_freq'] = file['Res']['HRV']['Frequency']['AR']['LF_peak'][()][0][0]
-        
-        kubios_data['ar_peak_lf_power'] = None
-        try:
-            peak_lf_idx = list(file['Res']['HRV']['Frequency']['AR']['F'][()][0]).index(kubios_data['ar_peak_lf_freq'])
-            kubios_data['ar_peak_lf_power'] = file['Res']['HRV']['Frequency']['AR']['PSD'][()][0][peak_lf_idx]
-        except ValueError:
-            warn("Value for LF peak Y (PSD) could not be found - you'll have to enter it manually.")
+    with results.KubiosResults(kubios_data_file) as kubios_results:
+        kubios_settings = kubios_results.settings()
+        kubios_data['hr_max'] = kubios_results.scalar('Res/HRV/Statistics/max_HR')
+        kubios_data['hr_min'] = kubios_results.scalar('Res/HRV/Statistics/min_HR')
+        kubios_data['hr_mean'] = kubios_results.scalar('Res/HRV/Statistics/mean_HR')
+        kubios_data['rmssd'] = 1000 * kubios_results.scalar('Res/HRV/Statistics/RMSSD') # multiply by 1000 to get it in ms
+        kubios_data['ar_abs_lf_power'] = kubios_results.scalar('Res/HRV/Frequency/AR/LF_power')
+        kubios_data['ar_peak_lf_freq'] = kubios_results.scalar('Res/HRV/Frequency/AR/LF_peak')
+
+        ar_freqs = kubios_results.row('Res/HRV/Frequency/AR/F')
+        ar_psd = kubios_results.row('Res/HRV/Frequency/AR/PSD')
+        peak_lf_idx = spectrum.nearest_freq_index(ar_freqs, kubios_data['ar_peak_lf_freq'])[0]
+        kubios_data['ar_peak_lf_power'] = ar_psd[peak_lf_idx]
 
         # we're checking to see if there are "multiple" peaks, defined as any other PSD
         # value that is >= 0.25x the peak value that is separated from the peak by one or more
         # values that are <= 0.25x the peak value. We search to the left and right of the peak.
-        kubios_data['has_multi_peak'] = None
-        try:
-            fft_peak_lf_freq = file['Res']['HRV']['Frequency']['Welch']['LF_peak'][()][0][0]
-            peak_fft_lf_idx = list(file['Res']['HRV']['Frequency']['Welch']['F'][()][0]).index(fft_peak_lf_freq)
-            fft_psd = list(file['Res']['HRV']['Frequency']['Welch']['PSD'][()][0])
-        except ValueError:
-            warn("Value for peak (FFT) frequency couldn't be found - you'll have to determine whether the FFT spectrum had single or multiple peaks and enter that manually.")
-            return (kubios_settings, kubios_data)
-
-    right_of_peak = fft_psd[peak_fft_lf_idx:]
-    left_of_peak = fft_psd[:peak_fft_lf_idx-1]
-    left_of_peak.reverse()
-    fft_peak_lf_power = fft_psd[peak_fft_lf_idx]
-    second_peak_limit = 0.25 * fft_peak_lf_power
-    try:
-        gap_idx = next(idx for idx, i in enumerate(right_of_peak) if i <= second_peak_limit)
-        kubios_data['has_multi_peak'] = len([x for x in right_of_peak[gap_idx:] if x >= second_peak_limit]) > 0
-    except StopIteration:
-        pass
-        # do nothing - there was no gap and therefore no second peak
-    
-    if not kubios_data['has_multi_peak']:
-        # no second peak to the right - check to the left
-        try:
-            gap_idx = next(idx for idx, i in enumerate(left_of_peak) if i <= second_peak_limit)
-            kubios_data['has_multi_peak'] = len([x for x in left_of_peak[gap_idx:] if x >= second_peak_limit]) > 0
-        except StopIteration:
-            pass
+        fft_peak_lf_freq = kubios_results.scalar('Res/HRV/Frequency/Welch/LF_peak')
+        fft_freqs = kubios_results.row('Res/HRV/Frequency/Welch/F')
+        fft_psd = kubios_results.row('Res/HRV/Frequency/Welch/PSD')
+
+    peak_fft_lf_idx = spectrum.nearest_freq_index(fft_freqs, fft_peak_lf_freq)
+    kubios_data['has_multi_peak'] = bool(spectrum.has_multiple_peaks(fft_psd, peak_fft_lf_idx)[0])
 
     return (kubios_settings, kubios_data)
 
+def rescore_multi_peaks(kubios_data_files, threshold=spectrum.MULTI_PEAK_THRESHOLD):
+    """Re-runs the multiple LF peak check on the Welch (FFT) spectra in each of the given kubios
+    output files using the given threshold, classifying all of them in one batch.
+    Returns a dict of file name -> True if the spectrum has multiple peaks."""
+    freqs = []
+    psds = []
+    peak_freqs = []
+    for f in kubios_data_files:
+        with results.KubiosResults(f) as kubios_results:
+            freqs.append(kubios_results.row('Res/HRV/Frequency/Welch/F'))
+            psds.append(kubios_results.row('Res/HRV/Frequency/Welch/PSD'))
+            peak_freqs.append(kubios_results.scalar('Res/HRV/Frequency/Welch/LF_peak'))
+    multi_peaks = spectrum.has_multiple_peaks_batch(freqs, psds, peak_freqs, threshold)
+    return {f: bool(multi) for (f, multi) in zip(kubios_data_files, multi_peaks)}
+
+def rescore_archive(mat_dir, threshold=spectrum.MULTI_PEAK_THRESHOLD, out=sys.stdout):
+    """Re-scores every kubios .mat file in mat_dir (see rescore_multi_peaks) and writes the file name
+    and 'single' or 'multiple' for each one to out as csv, in the form the spreadsheet uses"""
+    mat_files = sorted(str(f) for f in Path(mat_dir).glob('*.mat'))
+    multi_peaks = rescore_multi_peaks(mat_files, threshold)
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['File', 'LF peak single or multiple'])
+    for f in mat_files:
+        writer.writerow([Path(f).name, 'multiple' if multi_peaks[f] else 'single'])
+
 def write_data_to_sheet(sheet, subject_id, week, kubios_data, emwave_data):
     """Pulls relevant kubios output from kubios_data_file, merges it with emwave_data
      and writes it to a google spreadsheet.
@@ -237,6 +243,14 @@ def wait_and_exit(code):
     sys.exit(code)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'rescore':
+        # calibration.py rescore <dir of kubios .mat files> [threshold]
+        if len(sys.argv) not in [3, 4]:
+            print('Usage: calibration.py rescore <dir of kubios .mat files> [threshold, default {0}]'.format(spectrum.MULTI_PEAK_THRESHOLD))
+            sys.exit(2)
+        rescore_archive(sys.argv[2], float(sys.argv[3]) if len(sys.argv) == 4 else spectrum.MULTI_PEAK_THRESHOLD)
+        sys.exit(0)
+
     try:
         (subject_id, week, cutoff_date) = get_run_info()
         print('Fetching data for subject id {0} after {1}...'.format(subject_id, cutoff_date))
@@ -247,6 +261,7 @@ if __name__ == "__main__":
             wait_and_exit(0)
 
         temp_dir = kubios.expand_windows_short_name(tempfile.gettempdir())
+        coherence_engine = coherence.CoherenceEngine()
         for i in range(0, session_count):
             print("Processing session {0} of {1}...".format(i+1, session_count))
 
@@ -284,6 +299,19 @@ if __name__ == "__main__":
             if not expected_kubios_settings_ok(kubios_settings):
                 wait_and_exit(1)
 
+            # cross-check kubios against the native time-domain stats for the same 30s-270s sample,
+            # after applying the same sort of automatic artifact correction kubios does
+            (corrected_rr, pct_corrected) = artifacts.correct_artifacts(data['sessionData'][i]['rrData'])
+            print("Native artifact correction changed {0:.2f}% of beats.".format(pct_corrected))
+            native_stats = hrv.time_domain(corrected_rr, 30, 240)
+            for (name, kubios_value, native_value) in hrv.compare_with_kubios(kubios_data_file, native_stats):
+                warn("Kubios reported {0} as {1}, but the native calculation gives {2}.".format(name, kubios_value, native_value))
+
+            # and cross-check emWave's average coherence against the native coherence engine
+            native_coherence = coherence_engine.average(corrected_rr)
+            for (_, emwave_value, native_value) in coherence.emwave_mismatches([native_coherence], [data['sessionData'][i]['AvgCoherence']]):
+                warn("emWave reported AvgCoherence as {0}, but the native calculation gives {1}.".format(emwave_value, native_value))
+
             print("Uploading Kubios output files to S3...")
             upload_kubios_results(subject_id, results_path)
 
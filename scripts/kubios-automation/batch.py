@@ -0,0 +1,262 @@
+from concurrent.futures import ProcessPoolExecutor
+import acq
+import artifacts
+import coherence
+import csv
+import emwave as em
+import hrv
+import nonlinear
+import numpy as np
+import os
+from pathlib import PurePath
+import ppg
+import pulse
+import quality
+import shutil
+import spectrum
+import tempfile
+import uuid
+import windowed
+
+# File in the output dir the batch results are written to
+BATCH_RESULTS_FILE_NAME = 'batch-results.csv'
+
+# Number of emWave sessions each worker task decodes and analyses
+SESSIONS_PER_TASK = 16
+
+# Pulse data is downsampled to this rate (Hz) before beat detection, when it divides the sample rate
+BEAT_DETECTION_RATE = 1000
+
+# File in the output dir the sliding-window results are written to, if asked for
+BATCH_WINDOWS_FILE_NAME = 'batch-windows.csv'
+
+# Columns of the batch results file, in order
+RESULT_COLUMNS = (['source', 'session', 'start_time', 'n_beats', 'duration', 'quality_problems', 'artifact_pct']
+    + hrv.STAT_NAMES + ['LF_power', 'LF_peak'] + nonlinear.METRIC_NAMES + ['coherence', 'emwave_coherence'])
+
+# Columns of the sliding-window results file, in order
+WINDOW_COLUMNS = ['source', 'session', 'window_start'] + hrv.STAT_NAMES + ['LF_power', 'LF_peak', 'HF_power']
+
+# Each worker process scores coherence with a single engine, so that its buffers are
+# allocated once per process and reused for every series the process analyses
+_coherence_engine = None
+
+def coherence_engine():
+    global _coherence_engine
+    if _coherence_engine is None:
+        _coherence_engine = coherence.CoherenceEngine()
+    return _coherence_engine
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def share_array(share_dir, array):
+    """Writes array to a new memory-mapped file in share_dir and returns a small (path, dtype, shape)
+    handle to it, so that large arrays go between processes through the page cache rather than
+    being pickled. (multiprocessing.shared_memory needs Python 3.8; this works on 3.7.)"""
+    if array.size == 0:
+        return (None, array.dtype.str, array.shape)
+    path = os.path.join(share_dir, uuid.uuid4().hex)
+    shared = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+    shared[:] = array
+    shared.flush()
+    return (path, array.dtype.str, array.shape)
+
+def load_shared_array(handle):
+    """Returns a copy of the array a share_array handle refers to, and deletes its file"""
+    (path, dtype, shape) = handle
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    shared = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    array = np.array(shared)
+    # the map has to be closed before the file can be removed on Windows
+    del shared
+    os.remove(path)
+    return array
+
+def add_problem(row, problem):
+    """Appends problem to the quality_problems of a result row"""
+    row['quality_problems'] = '; '.join(p for p in [row.get('quality_problems'), problem] if p)
+
+def analyse_rr(rr, sample_start=None, sample_length=None, window=None):
+    """Returns a dict of the RESULT_COLUMNS computed from a series of RR intervals (ms):
+    data quality (see quality.triage) and, after artifact correction (see artifacts.correct_artifacts,
+    the native counterpart of kubios' automatic correction), the percentage of beats corrected,
+    time-domain, AR LF and nonlinear metrics and average coherence. sample_start and sample_length (s)
+    choose the sample the HRV metrics are computed over (see hrv.sample_window). Metrics that can't
+    be computed (e.g. too few beats) are left empty; if the analysis fails the error is added to
+    quality_problems and the metrics after it are left empty.
+    If window is a (window length, step) pair (s), the whole series is also analysed in sliding
+    windows (see windowed.windowed_analysis), and the result is under 'windows'."""
+    rr = np.asarray(rr, dtype=np.float64)
+    metrics = quality.quality_batch([rr])
+    row = {
+        'n_beats': len(rr),
+        'duration': metrics['duration'][0],
+        'quality_problems': '; '.join(quality.triage([rr])[0])
+    }
+    try:
+        (rr, row['artifact_pct']) = artifacts.correct_artifacts(rr)
+        row.update(hrv.time_domain(rr, sample_start, sample_length))
+        try:
+            ar = spectrum.ar_spectrum(rr, sample_start, sample_length)
+            row['LF_power'] = ar['LF_power']
+            row['LF_peak'] = ar['LF_peak']
+        except ValueError:
+            pass # too few beats to resample
+        row.update(nonlinear.nonlinear(rr, sample_start, sample_length))
+        row['coherence'] = coherence_engine().average(rr)
+        if window is not None:
+            row['windows'] = windowed.windowed_analysis(rr, window[0], window[1])
+    except Exception as e:
+        add_problem(row, 'analysis failed: {}'.format(e))
+    return row
+
+def emwave_task(emdb, session_uuids, sample_start, sample_length, share_dir, window=None):
+    """Decodes and analyses the given sessions from an emWave database (opened read-only, so any
+    number of workers can read it at once). Returns a list of (result row, shared RR array handle)."""
+    results = []
+    db = em.EmwaveDb(emdb, read_only=True)
+    db.open()
+    try:
+        for session in db.iter_sessions_by_uuid(session_uuids):
+            row = analyse_rr(session.rr_data, sample_start, sample_length, window)
+            row['session'] = session.session_uuid
+            row['start_time'] = session.start_time
+            row['emwave_coherence'] = session.avg_coherence
+            results.append((row, share_array(share_dir, np.asarray(session.rr_data, dtype=np.float64))))
+    finally:
+        db.close()
+    return results
+
+def pulse_txt_task(txt_file, layout, sample_start, sample_length, share_dir, window=None):
+    """Reads a pulse text file (layout holds pulse.iter_pulse_txt_data's arguments), detects its beats and
+    analyses them. Returns a one-element list of (result row, shared RR array handle)."""
+    sample_rate = layout['sample_rate']
+    rate = BEAT_DETECTION_RATE if sample_rate % BEAT_DETECTION_RATE == 0 else sample_rate
+    pulse_data = pulse.iter_pulse_txt_data(txt_file, layout['num_header_lines'], layout['column_separator'],
+        layout['time_column'], layout['data_column'], layout['data_unit'], sample_rate, rate)
+    rr = ppg.stream_rr_intervals(pulse_data, rate)
+    return [(analyse_rr(rr, sample_start, sample_length, window), share_array(share_dir, rr))]
+
+def acq_task(acq_file, chan_label, sample_start, sample_length, share_dir, window=None):
+    """Reads the channel labeled chan_label from an acq file, detects its beats and analyses them.
+    Returns a one-element list of (result row, shared RR array handle)."""
+    with acq.AcqFile(acq_file) as acq_file_reader:
+        channel = acq_file_reader.find_channel(chan_label)
+        rr = ppg.stream_rr_intervals(acq_file_reader.iter_samples(channel), channel.sample_rate)
+    return [(analyse_rr(rr, sample_start, sample_length, window), share_array(share_dir, rr))]
+
+def emwave_tasks(input_files):
+    """Returns (source name, emdb, session uuids) for each chunk of SESSIONS_PER_TASK sessions of each user
+    in each emWave database, in file, user and session order. Uses (and if needed builds) each database's
+    SessionIndex, so no RR data is read here."""
+    tasks = []
+    for emdb in input_files:
+        index = em.SessionIndex.load(str(emdb))
+        for name in index.user_names():
+            uuids = index.session_uuids(name)
+            for i in range(0, len(uuids), SESSIONS_PER_TASK):
+                tasks.append(('{}/{}'.format(PurePath(emdb).name, name), str(emdb), uuids[i:i + SESSIONS_PER_TASK]))
+    return tasks
+
+def _run_task(task):
+    """Runs a task, turning any error (e.g. an unreadable file) into a single result row that
+    records it, with no RR data, so that one bad input doesn't stop the rest of the batch"""
+    (fn, args) = task
+    try:
+        return fn(*args)
+    except Exception as e:
+        row = {}
+        add_problem(row, 'failed: {}'.format(e))
+        return [(row, None)]
+
+def run_batch(tasks, workers=None):
+    """Runs each of the (function, args) tasks in a pool of worker processes and returns their
+    results in the same order as the tasks, however the work was spread across the pool."""
+    workers = workers or default_workers()
+    if workers == 1:
+        return [_run_task(t) for t in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_task, tasks, chunksize=1))
+
+def write_rr_file(rr_dir, name, rr):
+    fname = os.path.join(rr_dir, name + '.txt')
+    with open(fname, 'w') as f:
+        f.writelines("%d\n" % round(d) for d in rr)
+    return fname
+
+def _csv_row(row):
+    """Leaves NaNs (metrics that couldn't be computed) empty"""
+    return {k: ('' if isinstance(v, float) and np.isnan(v) else v) for (k, v) in row.items()}
+
+def process_in_batch(file_type, input_files, output_path, params, workers=None):
+    """Analyses all of input_files natively (without Kubios) in a pool of worker processes.
+    file_type is one of 'em', 'txt' or 'acq' (see main.FILE_TYPE_TO_EXTENSION); params holds
+    sample_start and sample_length (s, or None) and, for pulse text files, the layout
+    (see pulse_txt_task) or, for acq files, chan_label. It may also hold window, a
+    (window length, step) pair (s) to analyse each whole series in sliding windows as well.
+    Writes one row per session (emWave) or file to BATCH_RESULTS_FILE_NAME in output_path and
+    each RR series to a file in output_path/rr, in input order, plus (with window) one row per
+    window to BATCH_WINDOWS_FILE_NAME. Inputs that can't be read or analysed get a row whose
+    quality_problems says why. For emWave sessions our average coherence is checked against emWave's
+    AvgCoherence (see coherence.emwave_mismatches).
+    Returns (the number of rows in BATCH_RESULTS_FILE_NAME, the number of sessions whose coherence
+    was checked, a list of (source, session, emwave_value, native_value) tuples for those that differ)."""
+    input_files = sorted(str(f) for f in input_files)
+    sample_start = params.get('sample_start')
+    sample_length = params.get('sample_length')
+    window = params.get('window')
+    share_dir = tempfile.mkdtemp(prefix='hrv-batch-')
+    try:
+        if file_type == 'em':
+            sources = emwave_tasks(input_files)
+            tasks = [(emwave_task, (emdb, uuids, sample_start, sample_length, share_dir, window)) for (_, emdb, uuids) in sources]
+            sources = [s[0] for s in sources]
+        elif file_type == 'txt':
+            sources = [PurePath(f).name for f in input_files]
+            tasks = [(pulse_txt_task, (f, params['layout'], sample_start, sample_length, share_dir, window)) for f in input_files]
+        elif file_type == 'acq':
+            sources = [PurePath(f).name for f in input_files]
+            tasks = [(acq_task, (f, params['chan_label'], sample_start, sample_length, share_dir, window)) for f in input_files]
+        else:
+            raise Exception("'{}' is not a supported file type.".format(file_type))
+
+        results = run_batch(tasks, workers)
+
+        rr_dir = os.path.join(str(output_path), 'rr')
+        os.makedirs(rr_dir, exist_ok=True)
+        num_rows = 0
+        checked = []
+        windows_file = open(os.path.join(str(output_path), BATCH_WINDOWS_FILE_NAME), 'w', newline='') if window is not None else None
+        try:
+            if windows_file:
+                windows_writer = csv.DictWriter(windows_file, fieldnames=WINDOW_COLUMNS, restval='')
+                windows_writer.writeheader()
+            with open(os.path.join(str(output_path), BATCH_RESULTS_FILE_NAME), 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS, restval='')
+                writer.writeheader()
+                for (source, task_results) in zip(sources, results):
+                    for (row, handle) in task_results:
+                        if handle is not None:
+                            rr = load_shared_array(handle)
+                            name = PurePath(source).stem if row.get('session') is None else '{}-{}'.format(source.replace('/', '-'), row['session'])
+                            write_rr_file(rr_dir, name, rr)
+                        row['source'] = source
+                        windows = row.pop('windows', None)
+                        writer.writerow(_csv_row(row))
+                        num_rows += 1
+                        if row.get('emwave_coherence') is not None:
+                            checked.append((source, row['session'], row['emwave_coherence'], row.get('coherence', np.nan)))
+                        if windows_file and windows is not None:
+                            for i in range(len(windows['start'])):
+                                window_row = {k: v[i] for (k, v) in windows.items() if k != 'start'}
+                                window_row.update({'source': source, 'session': row.get('session'), 'window_start': windows['start'][i]})
+                                windows_writer.writerow(_csv_row(window_row))
+        finally:
+            if windows_file:
+                windows_file.close()
+        mismatches = coherence.emwave_mismatches([c[3] for c in checked], [c[2] for c in checked])
+        return (num_rows, len(checked), [checked[i] for (i, _, _) in mismatches])
+    finally:
+        shutil.rmtree(share_dir, ignore_errors=True)
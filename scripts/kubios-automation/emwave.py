@@ -1,47 +1,362 @@
+from array import array
+from collections import namedtuple
+import hashlib
+import json
+import os
+from pathlib import Path
 import sqlite3
-import time
+import sys
+import tempfile
+
+# Default number of rows to pull from the sqlite cursor at a time when iterating over sessions
+FETCH_BATCH_SIZE = 32
+
+# Settings used for read-only and snapshot connections
+MMAP_SIZE = 256 * 1024 * 1024 # bytes of the database file sqlite may memory-map
+CACHE_SIZE_KB = 64 * 1024 # size of sqlite's page cache
+
+# Suffix appended to the database file name to get the path of its sidecar session index
+INDEX_SUFFIX = '.index.json'
+# Bump this whenever the format of the sidecar index changes
+INDEX_VERSION = 2
+
+def decode_live_ibi(blob):
+    """Given a LiveIBI blob from the emwave database, returns an array of
+    RR intervals (ms between heartbeats). The blob is a sequence of little-endian
+    16-bit unsigned ints; it is decoded in bulk rather than one value at a time."""
+    rr_data = array('H')
+    # a trailing odd byte can't be a complete RR interval - ignore it
+    rr_data.frombytes(blob[:len(blob) - (len(blob) % 2)])
+    if sys.byteorder == 'big':
+        rr_data.byteswap()
+    return rr_data
+
+class Session:
+    """A single emwave session. rr_data is an array of RR intervals (ms);
+    start_time and end_time are IBIStartTime and IBIEndTime (seconds since the epoch)
+    and session_uuid is Session.SessionUuid.
+    Iterating over a session (or calling len() on it) is the same as iterating over
+    its RR intervals."""
+
+    __slots__ = ('rr_data', 'start_time', 'end_time', 'avg_coherence', 'session_uuid')
+
+    def __init__(self, rr_data, start_time, end_time, avg_coherence, session_uuid=None):
+        self.rr_data = rr_data
+        self.start_time = start_time
+        self.end_time = end_time
+        self.avg_coherence = avg_coherence
+        self.session_uuid = session_uuid
+
+    def __iter__(self):
+        return iter(self.rr_data)
+
+    def __len__(self):
+        return len(self.rr_data)
+
+    def __getitem__(self, idx):
+        return self.rr_data[idx]
+
+    @property
+    def duration(self):
+        """Session duration in seconds, computed the same way the server-side calibration code does (IBIEndTime - IBIStartTime)"""
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return 'Session(start_time={}, end_time={}, avg_coherence={}, {} RR intervals)'.format(
+            self.start_time, self.end_time, self.avg_coherence, len(self.rr_data))
 
 class EmwaveDb:
 
-    def __init__(self, db_file_path):
+    def __init__(self, db_file_path, read_only=False, immutable=False, snapshot=False):
+        """db_file_path - Path to the emwave database
+        read_only      - Open the database in read-only mode, with memory-mapped I/O and a larger page cache
+        immutable      - Tell sqlite the database won't change while we have it open, so it can skip locking entirely.
+                         Implies read_only. Don't use this on a database the emWave app may be writing to.
+        snapshot       - Copy the database (using sqlite's online backup API, which is safe to use while
+                         emWave has it open) to a temporary file and read from the copy. Implies read_only.
+        """
         self.path = db_file_path
+        self.read_only = read_only or immutable or snapshot
+        self.immutable = immutable
+        self.snapshot = snapshot
+        self.snapshot_path = None
         self.conn = None
         self.c = None
 
+    @staticmethod
+    def _read_only_uri(db_file_path, immutable=False):
+        uri = Path(db_file_path).resolve().as_uri() + '?mode=ro'
+        if immutable:
+            uri += '&immutable=1'
+        return uri
+
     def open(self):
-        self.conn = sqlite3.connect(self.path)
+        if self.snapshot:
+            source = sqlite3.connect(self._read_only_uri(self.path), uri=True)
+            (fd, self.snapshot_path) = tempfile.mkstemp(suffix='.emdb', prefix='emwave-snapshot.')
+            os.close(fd)
+            try:
+                copy = sqlite3.connect(self.snapshot_path)
+                try:
+                    source.backup(copy)
+                finally:
+                    copy.close()
+            except BaseException:
+                # callers only close() an open database, so don't leave a partial copy behind
+                os.remove(self.snapshot_path)
+                self.snapshot_path = None
+                raise
+            finally:
+                source.close()
+            # nothing else knows about the copy, so it's safe to treat it as immutable
+            self.conn = sqlite3.connect(self._read_only_uri(self.snapshot_path, True), uri=True)
+        elif self.read_only:
+            self.conn = sqlite3.connect(self._read_only_uri(self.path, self.immutable), uri=True)
+        else:
+            self.conn = sqlite3.connect(self.path)
+
+        if self.read_only:
+            self.conn.execute('pragma query_only = 1')
+            self.conn.execute('pragma mmap_size = {}'.format(MMAP_SIZE))
+            self.conn.execute('pragma cache_size = -{}'.format(CACHE_SIZE_KB))
         self.c = self.conn.cursor()
 
     def close(self):
         if self.conn:
             self.conn.close()
+            self.conn = None
+        if self.snapshot_path:
+            os.remove(self.snapshot_path)
+            self.snapshot_path = None
 
     def _confirm_db_open(self):
         if not self.conn:
             raise Exception('You must call open() before fetching sessions')
 
-    def fetch_session_rr_data(self, username):
-        """Returns list of sessions. Each session contains a list of RR intervals (ms between heartbeats).
+    @staticmethod
+    def _session_filter(start_time=None, end_time=None, min_duration=None):
+        """Returns a (sql, params) tuple with the conditions every session we fetch must meet.
+        The sql is meant to follow a 'where' (or 'on') clause in which the Session table is aliased as s."""
+        conditions = ['s.ValidStatus = 1', 's.DeleteFlag is null']
+        params = []
+        if start_time is not None:
+            conditions.append('s.IBIStartTime >= ?')
+            params.append(start_time)
+        if end_time is not None:
+            conditions.append('s.IBIStartTime < ?')
+            params.append(end_time)
+        if min_duration is not None:
+            conditions.append('(s.IBIEndTime - s.IBIStartTime) >= ?')
+            params.append(min_duration)
+        return (' and '.join(conditions), params)
 
-        username   - The name of the user (as found in User.FirstName in the emwave database) whose data you want
+    def iter_sessions(self, username, offset=0, limit=None, start_time=None, end_time=None, min_duration=None, batch_size=FETCH_BATCH_SIZE):
+        """Yields sessions one at a time, in IBIStartTime order. Each session is a Session holding an
+        array of RR intervals (ms between heartbeats) along with the session's start time, end time
+        and average coherence. Rows are read from the database batch_size at a time, so only that
+        many LiveIBI blobs are held in memory at once. All filtering is done by the database, so the
+        blobs of sessions that are filtered out or skipped are never read.
+
+        username     - The name of the user (as found in User.FirstName in the emwave database) whose data you want
+        offset       - The number of (matching) sessions to skip
+        limit        - The maximum number of sessions to return (None for no limit)
+        start_time   - Only return sessions whose IBIStartTime is >= this (seconds since the epoch)
+        end_time     - Only return sessions whose IBIStartTime is < this (seconds since the epoch)
+        min_duration - Only return sessions at least this many seconds long
+        batch_size   - The number of rows to fetch from the database at a time
         """
-        
+
+        self._confirm_db_open()
+
+        (conditions, params) = self._session_filter(start_time, end_time, min_duration)
+        stmt = 'select LiveIBI, IBIStartTime, IBIEndTime, AvgCoherence, SessionUuid from Session s join User u on s.UserUuid = u.UserUuid where u.FirstName = ? and {} order by IBIStartTime asc limit ? offset ?'.format(conditions)
+        # sqlite treats a negative limit as no limit
+        params = [username] + params + [-1 if limit is None else limit, offset]
+        # use a dedicated cursor so that other queries run while we're iterating don't reset it
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(stmt, params)
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield Session(decode_live_ibi(row[0]), row[1], row[2], row[3], row[4])
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
+    def iter_sessions_by_uuid(self, session_uuids, batch_size=FETCH_BATCH_SIZE):
+        """Yields the sessions with the given SessionUuids one at a time, in IBIStartTime order.
+        Used with a SessionIndex, which chooses the sessions without reading any RR data."""
+
         self._confirm_db_open()
 
-        sessions = list()
-        stmt = 'select LiveIBI from Session s join User u on s.UserUuid = u.UserUuid where u.FirstName = ? and s.ValidStatus = 1 and s.DeleteFlag is null order by IBIStartTime asc'
-        for row in self.c.execute(stmt, (username, )):
-            rr_data = list()
-            for i in range(0, len(row[0]), 2):
-                rr_data.append(int.from_bytes(row[0][i:i+2], byteorder='little'))
-            sessions.append(rr_data)
+        # sqlite limits the number of parameters a statement may have, so look the sessions up in chunks
+        session_uuids = list(session_uuids)
+        for i in range(0, len(session_uuids), batch_size):
+            chunk = session_uuids[i:i + batch_size]
+            stmt = 'select LiveIBI, IBIStartTime, IBIEndTime, AvgCoherence, SessionUuid from Session where SessionUuid in ({}) order by IBIStartTime asc'.format(','.join('?' * len(chunk)))
+            for row in self.conn.execute(stmt, chunk).fetchall():
+                yield Session(decode_live_ibi(row[0]), row[1], row[2], row[3], row[4])
 
-        return sessions
+    def fetch_session_rr_data(self, username, offset=0, limit=None, start_time=None, end_time=None, min_duration=None):
+        """Returns list of sessions. Each session is a Session holding an array of RR intervals
+        (ms between heartbeats) along with the session's start time, end time and average coherence.
+        Prefer iter_sessions when you don't need all of the sessions in memory at once.
+
+        username   - The name of the user (as found in User.FirstName in the emwave database) whose data you want
+        See iter_sessions for the remaining arguments.
+        """
+        return list(self.iter_sessions(username, offset, limit, start_time, end_time, min_duration))
+
+    def count_sessions(self, username, start_time=None, end_time=None, min_duration=None):
+        """Returns the number of valid sessions for the given user without reading any RR data.
+        See iter_sessions for the filtering arguments."""
+        self._confirm_db_open()
+        (conditions, params) = self._session_filter(start_time, end_time, min_duration)
+        stmt = 'select count(*) from Session s join User u on s.UserUuid = u.UserUuid where u.FirstName = ? and {}'.format(conditions)
+        self.c.execute(stmt, [username] + params)
+        return self.c.fetchone()[0]
+
+    def fetch_session_index_rows(self):
+        """Returns (FirstName, SessionUuid, IBIStartTime, IBIEndTime, LiveIBI length in bytes, AvgCoherence)
+        tuples for every valid session in the database, ordered by User row and then IBIStartTime (so
+        if two users share a FirstName their sessions come in separate runs). Users with no valid
+        sessions get a single row with None for everything but the name.
+        No RR data are read."""
+        self._confirm_db_open()
+        (conditions, params) = self._session_filter()
+        stmt = 'select u.FirstName, s.SessionUuid, s.IBIStartTime, s.IBIEndTime, length(s.LiveIBI), s.AvgCoherence from User u left join Session s on s.UserUuid = u.UserUuid and {} order by u.rowid, s.IBIStartTime asc'.format(conditions)
+        return self.c.execute(stmt, params).fetchall()
 
     def fetch_user_first_names(self):
         self._confirm_db_open()
         self.c.execute('select FirstName from User')
         return [i[0] for i in self.c.fetchall()]
 
+IndexedSession = namedtuple('IndexedSession', ['session_uuid', 'start_time', 'end_time', 'duration', 'byte_length', 'avg_coherence'])
+
+def file_signature(db_file_path, chunk_size=1024 * 1024):
+    """Returns a dict with the size, mtime and sha256 hash of the given file"""
+    sha = hashlib.sha256()
+    with open(db_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    stat = os.stat(db_file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha.hexdigest()}
+
+class SessionIndex:
+    """A sidecar index of the users and sessions in an emwave database, stored as json next to
+    the database (or at index_path). It records each user's session uuids, start/end times,
+    durations, LiveIBI byte lengths and coherence so that users can be listed and sessions
+    counted and chosen without querying the database.
+
+    The index is keyed by the database's size, mtime and sha256 hash. If the size and mtime
+    still match the index is used as-is. If they don't, the database is re-hashed; if the hash
+    still matches (e.g. the file was copied) the index is kept, otherwise it is rebuilt.
+    """
+
+    def __init__(self, db_file_path, index_path=None):
+        self.db_path = str(db_file_path)
+        self.index_path = index_path if index_path else self.db_path + INDEX_SUFFIX
+        self.signature = None
+        self.users = {}
+
+    @classmethod
+    def load(cls, db_file_path, index_path=None):
+        """Returns an up-to-date index for the given database, rebuilding (and saving) it if necessary.
+        If the index can't be saved (e.g. the database's directory isn't writable) the in-memory
+        index is still returned; it will just have to be rebuilt next time."""
+        index = cls(db_file_path, index_path)
+        if not index._read():
+            index.rebuild(save=False)
+            index._save_if_possible()
+        return index
+
+    def _read(self):
+        """Reads the index file. Returns True if it exists and matches the database, False otherwise."""
+        try:
+            with open(self.index_path, 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        try:
+            if saved.get('version') != INDEX_VERSION:
+                return False
+            signature = saved['signature']
+            users = {name: [IndexedSession(*s) for s in sessions] for (name, sessions) in saved['users']}
+            stat = os.stat(self.db_path)
+            changed = signature['size'] != stat.st_size or signature['mtime'] != stat.st_mtime
+            if changed:
+                current = file_signature(self.db_path)
+                if current['sha256'] != signature['sha256']:
+                    return False
+                signature = current
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # valid json, but not an index we wrote; treat it as stale
+            return False
+
+        self.signature = signature
+        self.users = users
+        if changed:
+            # contents are the same; save the new size/mtime so we don't have to hash again next time
+            self._save_if_possible()
+        return True
+
+    def rebuild(self, save=True):
+        """Rebuilds the index from the database and (if save is true) saves it"""
+        signature = file_signature(self.db_path)
+        db = EmwaveDb(self.db_path, read_only=True)
+        db.open()
+        try:
+            rows = db.fetch_session_index_rows()
+        finally:
+            db.close()
+
+        users = {}
+        for (name, uuid, start, end, byte_length, coherence) in rows:
+            sessions = users.setdefault(name, [])
+            if uuid is not None:
+                sessions.append(IndexedSession(uuid, start, end, end - start, byte_length, coherence))
+        # users that share a FirstName are one user to iter_sessions, so put their sessions in one start time order
+        for sessions in users.values():
+            sessions.sort(key=lambda s: s.start_time)
+        self.signature = signature
+        self.users = users
+        if save:
+            self.save()
+
+    def save(self):
+        # users are stored as a list of pairs to preserve their order
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'signature': self.signature,
+                'users': [[name, [list(s) for s in sessions]] for (name, sessions) in self.users.items()]
+            }, f)
+        # replace the old index in one step so that a crash never leaves it half-written
+        os.replace(tmp_path, self.index_path)
+
+    def _save_if_possible(self):
+        try:
+            self.save()
+        except OSError as err:
+            print("Couldn't save the session index to {} ({}); carrying on without it.".format(self.index_path, err), file=sys.stderr)
+
+    def user_names(self):
+        return list(self.users.keys())
+
+    def sessions(self, username, offset=0, limit=None, start_time=None, end_time=None, min_duration=None):
+        """Returns the IndexedSessions for the given user, filtered the same way EmwaveDb.iter_sessions filters them"""
+        sessions = [s for s in self.users.get(username, []) if
+            (start_time is None or s.start_time >= start_time) and
+            (end_time is None or s.start_time < end_time) and
+            (min_duration is None or s.duration >= min_duration)]
+        return sessions[offset:] if limit is None else sessions[offset:offset + limit]
+
+    def count_sessions(self, username, start_time=None, end_time=None, min_duration=None):
+        return len(self.sessions(username, start_time=start_time, end_time=end_time, min_duration=min_duration))
 
-    
\ No newline at end of file
+    def session_uuids(self, username, offset=0, limit=None, start_time=None, end_time=None, min_duration=None):
+        """Returns the uuids of the chosen sessions, for use with EmwaveDb.iter_sessions_by_uuid"""
+        return [s.session_uuid for s in self.sessions(username, offset, limit, start_time, end_time, min_duration)]
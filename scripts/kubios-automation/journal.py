@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import results
+import time
+
+# File in the output dir the journal is kept in
+JOURNAL_FILE_NAME = 'run-journal.jsonl'
+
+# Stages an item (an input file or emWave session) goes through, in order
+EXPORTED = 'exported' # its data has been prepared (e.g. RR file written) for kubios
+ANALYSED = 'analysed' # kubios has analysed it
+SAVED = 'saved' # kubios has saved its results and the output files all exist
+VERIFIED = 'verified' # the settings in its results have been checked
+FAILED = 'failed'
+STAGES = [EXPORTED, ANALYSED, SAVED, VERIFIED, FAILED]
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RunJournal:
+    """Append-only journal, in output_dir, of the stage each item of a kubios run has reached.
+    Each record is one line of json, written in a single write and synced to disk, so a crash
+    can at worst leave a torn last line, which is ignored when the journal is read back.
+    An item is complete once it has been verified and its output files still match the
+    checksums recorded then; with resume true, complete items are skipped (see should_skip)
+    if they were analysed with the same settings."""
+
+    def __init__(self, output_dir, resume=False):
+        self.path = os.path.join(str(output_dir), JOURNAL_FILE_NAME)
+        self.output_dir = str(output_dir)
+        self.resume = resume
+        self.items = {}
+        self._file = None
+
+    def open(self):
+        line = b'\n'
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue # torn write from a crash
+                    self.items[record['item']] = record
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if not line.endswith(b'\n'):
+            self._file.write('\n')
+        return self
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, item, stage, settings=None, results_path=None, reason=None):
+        """Appends a record that item has reached stage. For the VERIFIED stage, results_path
+        (the dir+prefix of its kubios output files) must be given and a checksum of each file is recorded."""
+        if stage not in STAGES:
+            raise Exception("'{}' is not a journal stage.".format(stage))
+        record = {'item': item, 'stage': stage, 'time': time.time()}
+        if settings is not None: record['settings'] = settings
+        if reason is not None: record['reason'] = reason
+        if results_path is not None:
+            record['results'] = os.path.relpath(str(results_path), self.output_dir)
+            if stage == VERIFIED:
+                record['outputs'] = {s: file_checksum(str(results_path) + s) for s in results.OUTPUT_SUFFIXES}
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.items[item] = record
+
+    def is_complete(self, item, settings=None):
+        """Returns true if item has been verified (with the same settings, if they're given)
+        and its output files are still there and unchanged"""
+        record = self.items.get(item)
+        if record is None or record['stage'] != VERIFIED:
+            return False
+        if settings is not None and record.get('settings') != settings:
+            return False
+        prefix = os.path.join(self.output_dir, record['results'])
+        try:
+            return all(file_checksum(prefix + s) == checksum for (s, checksum) in record['outputs'].items())
+        except OSError:
+            return False
+
+    def should_skip(self, item, settings=None):
+        """Returns true if this is a resumed run and item is already complete"""
+        return self.resume and self.is_complete(item, settings)
+
+    def summary(self):
+        """Returns the number of (verified, failed, incomplete) items in the journal"""
+        stages = [r['stage'] for r in self.items.values()]
+        num_verified = stages.count(VERIFIED)
+        num_failed = stages.count(FAILED)
+        return (num_verified, num_failed, len(stages) - num_verified - num_failed)
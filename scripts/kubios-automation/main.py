@@ -1,10 +1,24 @@
+import acq
+import batch
+import coherence
 import emwave as em
+import journal
+import json
 import kubios
+import multiprocessing
+import os
+import ppg
+import pulse
 from pathlib import Path, PurePath
+import quality
+import result_cache
+import results
+import shutil
 import sys
 import tempfile
 import time
 import traceback
+import windowed
 from pywinauto.timings import TimeoutError
 
 # Path to kubios application
@@ -14,10 +28,31 @@ EMWAVE_FILE_TYPE = 'em'
 ACQ_FILE_TYPE = 'acq'
 PULSE_TEXT_FILE_TYPE = 'txt'
 
+# Not a file type: re-checks the kubios results already in the output dir
+VERIFY_OUTPUT_RUN_TYPE = 'verify'
+
 # Output is stored in a dir that's a sibling to the input dir
 # Directory will be created if it doesn't already exist
 OUTPUT_DIR_NAME = 'output'
 
+# File in the output dir recording, per emWave database and user, the IBIStartTime
+# of the most recent session that was successfully analysed and verified
+HIGH_WATER_MARKS_FILE_NAME = 'emwave-high-water-marks.json'
+
+# Kubios results are cached here, keyed by the RR data and the analysis settings, so
+# sessions that have already been analysed with the same settings skip the Kubios GUI
+RESULT_CACHE_DIR = Path.home() / '.kubios-result-cache'
+RESULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Settings every session is analysed with in Kubios (see confirm_expected_settings)
+AR_MODEL = 16
+ARTIFACT_CORRECTION = 'Automatic correction'
+
+# Data-quality thresholds emWave sessions are triaged against before being sent to Kubios
+TRIAGE_MIN_DURATION = quality.MIN_DURATION # seconds
+TRIAGE_MAX_PCT_IMPLAUSIBLE = quality.MAX_PCT_IMPLAUSIBLE
+TRIAGE_MAX_PCT_DROPOUT = quality.MAX_PCT_DROPOUT
+
 FILE_TYPE_TO_EXTENSION = {
     EMWAVE_FILE_TYPE: '.emdb', 
     ACQ_FILE_TYPE: '.acq',
@@ -25,7 +60,7 @@ FILE_TYPE_TO_EXTENSION = {
 }
 
 def get_run_info():
-    file_type = get_valid_response("File type (emWave [{}], Pulse ACQ [{}], Pulse Text [{}]): ".format(EMWAVE_FILE_TYPE, ACQ_FILE_TYPE, PULSE_TEXT_FILE_TYPE), lambda res: [EMWAVE_FILE_TYPE, ACQ_FILE_TYPE, PULSE_TEXT_FILE_TYPE].count(res) == 1)
+    file_type = get_valid_response("File type (emWave [{}], Pulse ACQ [{}], Pulse Text [{}]) or verify existing output [{}]: ".format(EMWAVE_FILE_TYPE, ACQ_FILE_TYPE, PULSE_TEXT_FILE_TYPE, VERIFY_OUTPUT_RUN_TYPE), lambda res: [EMWAVE_FILE_TYPE, ACQ_FILE_TYPE, PULSE_TEXT_FILE_TYPE, VERIFY_OUTPUT_RUN_TYPE].count(res) == 1)
     input_dir = input("Directory with input files: ")
 
     return (file_type, input_dir)
@@ -35,49 +70,111 @@ def get_input_files(input_dir, file_type):
     input_path = Path(input_dir)
     return [f for f in input_path.iterdir() if f.is_file() and PurePath(f).suffix == file_ext]
 
-def write_emwave_data_to_files(fname, user_name):
-    """Given a user_name and an fname pointing to an emWave database,
-    writes a file with the RR data for each session found for that user.
-    Returns a list of (file name, session duration (ms)) tuples"""
-    emwave_db = em.EmwaveDb(fname)
-    emwave_db.open()
-    sessions = emwave_db.fetch_session_rr_data(user_name)
-    emwave_db.close()
-
-    rr_file_names = list()
-    for idx, rr_data in enumerate(sessions):
+def triage_session(session):
+    """Checks the RR data of an emWave session against the TRIAGE_* thresholds.
+    Returns an empty list if it passes and a list of reasons it failed if not."""
+    return quality.triage([session.rr_data], TRIAGE_MIN_DURATION, TRIAGE_MAX_PCT_IMPLAUSIBLE, TRIAGE_MAX_PCT_DROPOUT)[0]
+
+def write_rr_sessions_to_files(sessions, user_name, first_idx=0, drop_failed_triage=None, skip=None):
+    """Given an iterable of emWave sessions for user_name, writes a file with
+    the RR data for each session. first_idx is the index of the first session
+    (i.e. the number of sessions that were skipped) and is used in the file names.
+    If drop_failed_triage is not None each session is triaged (see triage_session) before
+    it is written; sessions that fail are reported, and if drop_failed_triage is True they
+    are dropped. If given, sessions for which skip(session) is true (e.g. ones a resumed run
+    has already completed) are passed over.
+    This is a generator: sessions are written out one at a time as the caller asks for them,
+    yielding a (file name, session duration (ms), session start time, session index) tuple for each.
+    The duration is the sum of the session's RR intervals (not IBIEndTime - IBIStartTime, which can
+    be longer than the RR data), since it is used as the kubios sample length."""
+    for idx, session in enumerate(sessions, first_idx):
+        if skip is not None and skip(session):
+            print("Session {} was completed in an earlier run; skipping.".format(idx + 1))
+            continue
+        if drop_failed_triage is not None:
+            problems = triage_session(session)
+            if problems:
+                kubios.warn("Session {} {}: {}".format(idx + 1, 'skipped' if drop_failed_triage else 'may be unusable', '; '.join(problems)))
+                if drop_failed_triage:
+                    continue
         fname = tempfile.NamedTemporaryFile(suffix='.txt', prefix='{}-session{:02d}.'.format(user_name, idx), delete=False)
-        duration = 0
         with open(fname.name, 'w') as f:
-            for d in rr_data:
-                duration += int(d)
-                f.write("%d\n" % d)
-        rr_file_names.append((fname.name, duration))
+            f.writelines("%d\n" % d for d in session.rr_data)
+        yield (fname.name, sum(session.rr_data), session.start_time, idx)
 
-    return rr_file_names
+def load_high_water_marks(output_path):
+    """Returns the {emWave database file name: {user name: IBIStartTime}} dict saved in output_path,
+    or an empty dict if there isn't one."""
+    try:
+        with open(str(output_path / HIGH_WATER_MARKS_FILE_NAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_high_water_mark(output_path, high_water_marks, emdb_name, user_name, start_time):
+    """Records start_time as the IBIStartTime of the latest session for user_name in emdb_name
+    that has been analysed and verified, and saves all of the high_water_marks to output_path"""
+    high_water_marks.setdefault(emdb_name, {})[user_name] = start_time
+    marks_file = output_path / HIGH_WATER_MARKS_FILE_NAME
+    tmp_file = str(marks_file) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(high_water_marks, f, indent=2)
+    # replace the old file in one step so that a crash never leaves it half-written
+    os.replace(tmp_file, str(marks_file))
 
 def process_emwave_files(input_files):
+    high_water_marks = load_high_water_marks(output_path)
     for emdb in input_files:
         print("Processing {}...".format(emdb))
-        sample_start = get_valid_response("Where should the sample start? (mm:ss) [00:00] ", is_valid_min_sec)
-        sample_length = get_valid_response("How long should the sample be? (mm:ss) [use full session]", is_valid_min_sec)
-        db = em.EmwaveDb(emdb)
+        sample_start = get_valid_response("Where should the sample start? (hh:mm:ss or mm:ss) [00:00] ", is_valid_min_sec)
+        sample_length = get_valid_response("How long should the sample be? (hh:mm:ss or mm:ss) [use full session] ", is_valid_min_sec)
+        only_new = get_valid_response("Only process sessions recorded since the last successful run? [Y(es)/n(o)] ", lambda resp: ['', 'Y', 'y', 'N', 'n'].count(resp) > 0)
+        only_new = only_new == '' or only_new == 'Y' or only_new == 'y'
+        drop_failed = get_valid_response("Skip sessions that fail data-quality checks? [Y(es)/n(o), just flag them] ", lambda resp: ['', 'Y', 'y', 'N', 'n'].count(resp) > 0)
+        drop_failed = drop_failed == '' or drop_failed == 'Y' or drop_failed == 'y'
+        emdb_name = PurePath(emdb).name
+        # users, session counts and the sessions to process all come from the sidecar index;
+        # the database is only read for the RR data of the sessions we actually process
+        index = em.SessionIndex.load(emdb)
+        db = em.EmwaveDb(emdb, read_only=True)
         db.open()
-        emwave_user_names = db.fetch_user_first_names()
-        db.close()
-        for name in emwave_user_names:
-            should_process = get_valid_response("\tProcess user {}? [Y(es)/n(o)/s(kip) to next emWave file] ".format(name), lambda resp: ['', 'Y', 'y', 'N', 'n', 'S', 's'].count(resp) > 0)
-            if should_process == '' or should_process == 'Y' or should_process == 'y':
-                rr_session_files = write_emwave_data_to_files(str(emdb), name)
-                skip_count = get_valid_response(
-                    "\tFound {} sessions. How many sessions should be skipped? [0] ".format(len(rr_session_files)), 
-                    lambda resp: resp == '' or (is_int(resp) and 0 <= int(resp) < len(rr_session_files)))
-                if skip_count == '': skip_count = 0
-                export_rr_sessions_to_kubios(rr_session_files, output_path, sample_length, sample_start, int(skip_count))
-            elif should_process == 'N' or should_process == 'n':
-                continue
-            elif should_process == 'S' or should_process == 's':
-                break
+        try:
+            for name in index.user_names():
+                should_process = get_valid_response("\tProcess user {}? [Y(es)/n(o)/s(kip) to next emWave file] ".format(name), lambda resp: ['', 'Y', 'y', 'N', 'n', 'S', 's'].count(resp) > 0)
+                if should_process == '' or should_process == 'Y' or should_process == 'y':
+                    num_sessions = index.count_sessions(name)
+                    new_since = None
+                    already_processed = 0
+                    high_water_mark = high_water_marks.get(emdb_name, {}).get(name)
+                    if only_new and high_water_mark is not None:
+                        new_since = high_water_mark + 1
+                        already_processed = num_sessions - index.count_sessions(name, start_time=new_since)
+                        print("\t{} of {} sessions were processed in earlier runs.".format(already_processed, num_sessions))
+                    num_remaining = num_sessions - already_processed
+                    if num_remaining == 0:
+                        print("\tNo sessions to process.")
+                        continue
+
+                    skip_count = get_valid_response(
+                        "\tFound {} sessions. How many sessions should be skipped? [0] ".format(num_remaining),
+                        lambda resp: resp == '' or (is_int(resp) and 0 <= int(resp) < num_remaining))
+                    if skip_count == '': skip_count = 0
+                    skip_count = int(skip_count)
+                    sessions = db.iter_sessions_by_uuid(index.session_uuids(name, offset=skip_count, start_time=new_since))
+                    first_idx = already_processed + skip_count
+                    settings = {'sample_start': sample_start, 'sample_length': sample_length}
+                    session_item = lambda start_time: '{}/{}/{}'.format(emdb_name, name, start_time)
+                    rr_session_files = write_rr_sessions_to_files(sessions, name, first_idx, drop_failed,
+                        lambda session: run_journal.should_skip(session_item(session.start_time), settings))
+                    export_rr_sessions_to_kubios(rr_session_files, num_sessions, output_path, sample_length, sample_start,
+                        lambda session_file: save_high_water_mark(output_path, high_water_marks, emdb_name, name, session_file[2]),
+                        run_journal=run_journal, item_name=lambda session_file: session_item(session_file[2]), journal_settings=settings)
+                elif should_process == 'N' or should_process == 'n':
+                    continue
+                elif should_process == 'S' or should_process == 's':
+                    break
+        finally:
+            db.close()
 
 def safe_get_kubios(already_running_ok=False):
     """Returns a reference to the kubios app. If kubios is already running,
@@ -109,66 +206,149 @@ def save_and_close_kubios_results(app, kubios_window, input_file):
 
     return str(results_path)
 
-def confirm_expected_settings(results_path, sample_length, sample_start, ppg_sample_rate=None, ar_model=16, artifact_correction='Automatic correction'):
-    """Checks the matlab version of the kubios output at results_path to see
-    if the values it has for certain variables match what we expect. Returns an
-    empty list if everything matches and a list of (value_name, expected_value, actual_value)
-    tuples if not. Note that sample_length and sample_start are in seconds."""
-
+def expected_settings(sample_length, sample_start, ppg_sample_rate=None, ar_model=AR_MODEL, artifact_correction=ARTIFACT_CORRECTION):
+    """Returns a dict of the settings we expect kubios to have used (see results.unexpected_settings).
+    Note that sample_length and sample_start are in seconds."""
     expected = {}
     expected['ar_model'] = ar_model
     expected['artifact_correction']  = artifact_correction
     if (sample_start != None): expected['sample_start'] = sample_start
     if (sample_length != None): expected['sample_length'] = sample_length
     if ppg_sample_rate: expected['ppg_sample_rate'] = ppg_sample_rate
+    return expected
 
-    settings = kubios.get_settings(results_path + '.mat')
-    return [(k, expected[k], settings[k]) for k in expected.keys() if expected[k] != settings[k]]
-
-def export_rr_sessions_to_kubios(session_files, output_path, sample_length, sample_start, skip_count):
-    num_sessions = len(session_files)
-    sessions_to_use = session_files[skip_count:]
-    enumerated_sessions = list(enumerate(sessions_to_use, skip_count))
-
-    i = 0
-    while i < len(enumerated_sessions):
-        idx, (f, session_length) = enumerated_sessions[i]
-        print("Session {} of {}...".format(idx + 1, num_sessions)) 
-        already_running_ok = idx > 0 # get user to confirm kubios is ready on first file; assume it's ok on subsequent files
-        app = safe_get_kubios(already_running_ok)
+def confirm_expected_settings(results_path, sample_length, sample_start, ppg_sample_rate=None, ar_model=AR_MODEL, artifact_correction=ARTIFACT_CORRECTION):
+    """Checks the matlab version of the kubios output at results_path to see
+    if the values it has for certain variables match what we expect. Returns an
+    empty list if everything matches and a list of (value_name, expected_value, actual_value)
+    tuples if not. Note that sample_length and sample_start are in seconds."""
 
+    expected = expected_settings(sample_length, sample_start, ppg_sample_rate, ar_model, artifact_correction)
+    return results.unexpected_settings(kubios.get_settings(results_path + '.mat'), expected)
+
+def verify_output(output_path):
+    """Checks every kubios result in output_path for missing output files and
+    unexpected settings (see results.verify_output_dir) and prints a report.
+    Returns the number of results with problems."""
+    sample_start = get_valid_response("Where should the samples start? (hh:mm:ss or mm:ss) [don't check] ", is_valid_min_sec)
+    sample_length = get_valid_response("How long should the samples be? (hh:mm:ss or mm:ss) [don't check] ", is_valid_min_sec)
+    sample_start_sec = min_sec_to_sec(sample_start)
+    sample_length_sec = min_sec_to_sec(sample_length)
+    if sample_length_sec != None:
+        # Kubios writes sum of length and start to the .mat file as length
+        sample_length_sec = sample_length_sec + (sample_start_sec or 0)
+    expected = expected_settings(sample_length_sec, sample_start_sec)
+
+    report = results.verify_output_dir(str(output_path), expected)
+    num_bad = 0
+    for (prefix, missing, unexpected, err) in report:
+        if not (missing or unexpected or err):
+            continue
+        num_bad += 1
+        print("{}:".format(PurePath(prefix).name))
+        for f in missing:
+            print("\tmissing {}".format(PurePath(f).name))
+        for (name, expected_value, actual) in unexpected:
+            print("\t{0} should be '{1}' but is '{2}'".format(name, expected_value, actual))
+        if err:
+            print("\tcould not read results: {}".format(err))
+    print("Checked {} results; {} had problems.".format(len(report), num_bad))
+    return num_bad
+
+def record_stage(run_journal, item, stage, settings, results_path=None, reason=None):
+    """Records that item has reached stage in run_journal (see journal.RunJournal.record), if there is one"""
+    if run_journal is not None:
+        run_journal.record(item, stage, settings, results_path, reason)
+
+def check_output_files_exist(run_journal, item, settings, results_path):
+    """Exits if kubios didn't write all of the output files for item; otherwise records that it was saved"""
+    if not kubios.expected_output_files_exist(results_path):
+        record_stage(run_journal, item, journal.FAILED, settings, results_path, 'missing output files')
+        wait_and_exit(1)
+    record_stage(run_journal, item, journal.SAVED, settings, results_path)
+
+def check_settings(run_journal, item, settings, results_path, unexpected_settings):
+    """Reports any unexpected_settings (see confirm_expected_settings) kubios used for item and exits
+    if there are any; otherwise records that item has been verified"""
+    for (name, expected, actual) in unexpected_settings:
+        print("{0} should be '{1}' but is '{2}'. Please double-check Kubios and re-run.".format(name, expected, actual))
+
+    if len(unexpected_settings) > 0:
+        record_stage(run_journal, item, journal.FAILED, settings, results_path, 'unexpected settings')
+        wait_and_exit(2)
+    record_stage(run_journal, item, journal.VERIFIED, settings, results_path)
+
+def export_rr_sessions_to_kubios(session_files, num_sessions, output_path, sample_length, sample_start, on_session_verified=None, cache=None, run_journal=None, item_name=None, journal_settings=None):
+    """Runs each of the (file name, session duration (ms), session start time, session index) tuples
+    in session_files through Kubios. session_files may be any iterable (e.g. the generator returned by
+    write_rr_sessions_to_files); num_sessions is the user's total number of sessions.
+    If given, on_session_verified is called with the session_files tuple for each session
+    once its Kubios output has been saved and its settings checked.
+    Sessions whose RR data has already been analysed with the same settings are taken from
+    cache (a result_cache.ResultCache; by default the one in RESULT_CACHE_DIR) rather than Kubios.
+    If run_journal (a journal.RunJournal) is given, each session's progress is recorded in it under
+    the name item_name(session_file) returns, along with journal_settings (by default the
+    sample start and length), which a resumed run has to match to skip the session."""
+    if cache is None:
+        cache = result_cache.ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+    settings = journal_settings or {'sample_start': sample_start, 'sample_length': sample_length}
+    kubios_runs = 0
+    for session_file in session_files:
+        (f, session_length, _, idx) = session_file
+        print("Session {} of {}...".format(idx + 1, num_sessions))
+        item = item_name(session_file) if run_journal is not None else None
+        record_stage(run_journal, item, journal.EXPORTED, settings)
         f = kubios.expand_windows_short_name(f)
-        kubios.open_rr_file(app, f)
-        kubios_window = app.window(title_re='Kubios.*$', class_name='SunAwtFrame')
         if sample_length == '':
             sample_duration = millis_to_min_sec(session_length)
         else:
             sample_duration = sample_length
-        kubios.analyse(kubios_window, sample_duration, sample_start)
-
-        try:
-            results_path = save_and_close_kubios_results(app, kubios_window, f)
-            i = i + 1
-            if not kubios.expected_output_files_exist(results_path):
-                wait_and_exit(1)
-        except pywinauto.timings.TimeoutError:
-            # sometimes kubios hangs when saving a file
-            # give up and process it again
-            print("Error analyzing; trying again...")
-            kubios.close_without_saving(app)
-            continue
 
         sample_start_sec = min_sec_to_sec(sample_start)
         sample_duration_sec = min_sec_to_sec(sample_duration)
         if sample_start_sec != None and sample_duration_sec != None:
             # Kubios writes sum of length and start to the .mat file as length
             sample_duration_sec = sample_duration_sec + sample_start_sec
-        unexpected_settings = confirm_expected_settings(results_path, sample_duration_sec, sample_start_sec)
-        
-        for (name, expected, actual) in unexpected_settings:
-            print("{0} should be '{1}' but is '{2}'. Please double-check Kubios and re-run.".format(name, expected, actual))
-
-        if len(unexpected_settings) > 0: wait_and_exit(2)
+        cache_key = result_cache.cache_key(f, {
+            'sample_start': sample_start_sec,
+            'sample_length': sample_duration_sec,
+            'ar_model': AR_MODEL,
+            'artifact_correction': ARTIFACT_CORRECTION
+        })
+        results_path = str(output_path / PurePath(f).stem)
+        summary = cache.get(cache_key, results_path)
+        if summary is not None:
+            print("Using cached Kubios results.")
+            record_stage(run_journal, item, journal.SAVED, settings, results_path)
+            unexpected_settings = results.unexpected_settings(summary, expected_settings(sample_duration_sec, sample_start_sec))
+        else:
+            while True:
+                already_running_ok = kubios_runs > 0 # get user to confirm kubios is ready on first file; assume it's ok on subsequent files
+                app = safe_get_kubios(already_running_ok)
+
+                kubios.open_rr_file(app, f)
+                kubios_window = app.window(title_re='Kubios.*$', class_name='SunAwtFrame')
+                kubios.analyse(kubios_window, sample_duration, sample_start)
+                record_stage(run_journal, item, journal.ANALYSED, settings)
+
+                try:
+                    results_path = save_and_close_kubios_results(app, kubios_window, f)
+                    check_output_files_exist(run_journal, item, settings, results_path)
+                    break
+                except TimeoutError:
+                    # sometimes kubios hangs when saving a file
+                    # give up and process it again
+                    print("Error analyzing; trying again...")
+                    kubios.close_without_saving(app)
+            kubios_runs += 1
+
+            unexpected_settings = confirm_expected_settings(results_path, sample_duration_sec, sample_start_sec)
+            if len(unexpected_settings) == 0:
+                with results.KubiosResults(results_path + '.mat') as kubios_results:
+                    cache.put(cache_key, results_path, kubios_results.summary())
+
+        check_settings(run_journal, item, settings, results_path, unexpected_settings)
+        if on_session_verified: on_session_verified(session_file)
 
 def is_int(maybe_int):
     try:
@@ -177,9 +357,10 @@ def is_int(maybe_int):
     except ValueError:
         return False
     
-def get_pulse_txt_processing_params():
+def get_pulse_txt_processing_params(for_batch=False):
     """Asks the user for a number of parameters that control the processing of a
-    pulse txt file"""
+    pulse txt file. If for_batch is true, skips the questions that only matter when
+    the files are going through Kubios."""
     resp = {}
     num_header_lines = get_valid_response("How many header lines does each file have? ", lambda ans: is_int(ans) and int(ans) >= 0)
     num_header_lines = int(num_header_lines)
@@ -207,9 +388,17 @@ def get_pulse_txt_processing_params():
     sample_rate = get_valid_response("What is the sample rate? ", lambda ans: is_int(ans) and int(ans) > 0)
     sample_rate = int(sample_rate)
 
-    sample_start = get_valid_response("Where should the sample start? (mm:ss) ", is_valid_min_sec)
-    sample_length = get_valid_response("How long should the sample be? (mm:ss) ", is_valid_min_sec)
-        
+    sample_start = get_valid_response("Where should the sample start? (hh:mm:ss or mm:ss) ", is_valid_min_sec)
+    sample_length = get_valid_response("How long should the sample be? (hh:mm:ss or mm:ss) ", is_valid_min_sec)
+
+    downsample_rate = sample_rate
+    detect_beats = True
+    if not for_batch:
+        downsample_rate = get_valid_response("Downsample the pulse data to what rate? [don't downsample] ", lambda ans: ans == '' or (is_int(ans) and int(ans) > 0 and sample_rate % int(ans) == 0))
+        downsample_rate = sample_rate if downsample_rate == '' else int(downsample_rate)
+
+        detect_beats = get_valid_response("Detect beats here and send RR intervals to Kubios? [Y(es)/n(o), send the raw pulse data] ", lambda ans: ['', 'Y', 'y', 'N', 'n'].count(ans) == 1)
+        detect_beats = detect_beats == '' or detect_beats == 'Y' or detect_beats == 'y'
 
     resp['num_header_lines'] = num_header_lines
     resp['column_separator'] = col_sep
@@ -217,70 +406,209 @@ def get_pulse_txt_processing_params():
     resp['data_column'] = data_col
     resp['data_unit'] = data_unit
     resp['sample_rate'] = sample_rate
+    resp['downsample_rate'] = downsample_rate
     resp['sample_start'] = sample_start
     resp['sample_length'] = sample_length
+    resp['detect_beats'] = detect_beats
     return resp
 
+def write_pulse_rr_files(input_files, input_params, skip=None):
+    """Given pulse txt files laid out as described by input_params (see get_pulse_txt_processing_params),
+    detects the beats in each one and writes a file with its RR intervals. Files for which
+    skip(file) is true (if skip is given) are passed over.
+    This is a generator, yielding a (file name, duration (ms), None, file index) tuple for each,
+    in the form export_rr_sessions_to_kubios expects."""
+    for idx, f in enumerate(input_files):
+        if skip is not None and skip(f):
+            print("{} was completed in an earlier run; skipping.".format(PurePath(f).name))
+            continue
+        pulse_data = pulse.iter_pulse_txt_data(
+            str(f),
+            input_params['num_header_lines'],
+            input_params['column_separator'],
+            input_params['time_column'],
+            input_params['data_column'],
+            input_params['data_unit'],
+            input_params['sample_rate'],
+            input_params['downsample_rate'])
+        rr = ppg.stream_rr_intervals(pulse_data, input_params['downsample_rate'])
+        # name the RR file like the input file, since kubios names its results after it
+        rr_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(rr_dir, PurePath(f).stem + '.txt')
+            with open(fname, 'w') as rr_file:
+                rr_file.writelines("%d\n" % round(d) for d in rr)
+            yield (fname, rr.sum(), None, idx)
+        finally:
+            shutil.rmtree(rr_dir, ignore_errors=True)
+
 def process_pulse_txt_files(input_files):
     input_params = get_pulse_txt_processing_params()
     num_files = len(input_files)
+    # the journal tells files apart by name, and a resumed run has to be analysing them the same way
+    settings = {k: input_params[k] for k in ['sample_start', 'sample_length', 'sample_rate', 'downsample_rate', 'detect_beats']}
+    skip = lambda f: run_journal.should_skip(PurePath(f).name, settings)
+    if input_params['detect_beats']:
+        # kubios opens RR files far faster than it imports raw pulse data
+        rr_files = write_pulse_rr_files(input_files, input_params, skip)
+        export_rr_sessions_to_kubios(rr_files, num_files, output_path, input_params['sample_length'], input_params['sample_start'],
+            run_journal=run_journal, item_name=lambda rr_file: PurePath(input_files[rr_file[3]]).name, journal_settings=settings)
+        return
+
     for idx, f in enumerate(input_files):
+        item = PurePath(f).name
+        if skip(f):
+            print("{} was completed in an earlier run; skipping.".format(item))
+            continue
         f = str(f)
         print("File {} of {}...".format(idx + 1, num_files))
-        already_running_ok = idx > 0        
-        app = safe_get_kubios(already_running_ok)
-
-        f = kubios.expand_windows_short_name(f)
-        kubios.open_txt_file(
-        app,
-        f,
-        input_params['num_header_lines'],
-        input_params['column_separator'],
-        kubios.PPG_DATA_TYPE,
-        input_params['time_column'],
-        input_params['data_column'],
-        input_params['data_unit'],
-        input_params['sample_rate'])
-        kubios_window = app.window(title_re='Kubios.*$', class_name='SunAwtFrame'
-        )
-        print('Sleeping before doing analysis')
-        time.sleep(15)
-        print('Starting analysis')
-        kubios.analyse(kubios_window, input_params['sample_length'], input_params['sample_start'])
-        print('Finished with analysis')
+        layout = {
+            'num_header_lines': input_params['num_header_lines'],
+            'col_separator': input_params['column_separator'],
+            'time_index_col': input_params['time_column'],
+            'data_col': input_params['data_column'],
+            'data_unit': input_params['data_unit'],
+            'ppg_sample_rate': input_params['sample_rate']
+        }
+        downsample_dir = None
+        try:
+            if input_params['downsample_rate'] != input_params['sample_rate']:
+                # give kubios a (much smaller) decimated copy, named like the original so the results are too
+                downsample_dir = tempfile.mkdtemp()
+                downsampled = str(Path(downsample_dir) / PurePath(f).name)
+                print("Downsampling to {}...".format(input_params['downsample_rate']))
+                layout = pulse.downsample_pulse_txt(
+                    f,
+                    downsampled,
+                    input_params['num_header_lines'],
+                    input_params['column_separator'],
+                    input_params['time_column'],
+                    input_params['data_column'],
+                    input_params['data_unit'],
+                    input_params['sample_rate'],
+                    input_params['downsample_rate'])
+                f = downsampled
+            record_stage(run_journal, item, journal.EXPORTED, settings)
+
+            already_running_ok = idx > 0        
+            app = safe_get_kubios(already_running_ok)
+
+            f = kubios.expand_windows_short_name(f)
+            kubios.open_txt_file(
+            app,
+            f,
+            layout['num_header_lines'],
+            layout['col_separator'],
+            kubios.PPG_DATA_TYPE,
+            layout['time_index_col'],
+            layout['data_col'],
+            layout['data_unit'],
+            layout['ppg_sample_rate'])
+            kubios_window = app.window(title_re='Kubios.*$', class_name='SunAwtFrame'
+            )
+            print('Sleeping before doing analysis')
+            time.sleep(15)
+            print('Starting analysis')
+            kubios.analyse(kubios_window, input_params['sample_length'], input_params['sample_start'])
+            print('Finished with analysis')
+            record_stage(run_journal, item, journal.ANALYSED, settings)
 
-        results_path = save_and_close_kubios_results(app, kubios_window, f)
-        if not kubios.expected_output_files_exist(results_path):
-            wait_and_exit(1)
+            results_path = save_and_close_kubios_results(app, kubios_window, f)
+        finally:
+            # the decimated copy can be large; it isn't needed once kubios has saved the results
+            if downsample_dir is not None:
+                shutil.rmtree(downsample_dir, ignore_errors=True)
+        check_output_files_exist(run_journal, item, settings, results_path)
 
         sample_start_sec = min_sec_to_sec(input_params['sample_start'])
         sample_length_sec = min_sec_to_sec(input_params['sample_length']) + sample_start_sec
-        unexpected_settings = confirm_expected_settings(results_path, sample_length_sec, sample_start_sec, input_params['sample_rate'])
-        
-        for (name, expected, actual) in unexpected_settings:
-            print("{0} should be '{1}' but is '{2}'. Please double-check Kubios and re-run.".format(name, expected, actual))
+        unexpected_settings = confirm_expected_settings(results_path, sample_length_sec, sample_start_sec, layout['ppg_sample_rate'])
+        check_settings(run_journal, item, settings, results_path, unexpected_settings)
 
-        if len(unexpected_settings) > 0: wait_and_exit(2)
-
-def get_pulse_acq_processing_params():
+def get_pulse_acq_processing_params(for_batch=False):
     """Asks the user for a number of parameters that control the processing of an acq
-    file with pulse data"""
+    file with pulse data. If for_batch is true, skips the questions that only matter when
+    the files are going through Kubios."""
     resp = {}
     ecg_chan_label = input("What is the ECG channel label? (Please enter it exactly, including capitalization and any punctuation.) ")
-    sample_start = get_valid_response("Where should the sample start? (mm:ss) ", is_valid_min_sec)
-    sample_length = get_valid_response("How long should the sample be? (mm:ss) ", is_valid_min_sec)
+    sample_start = get_valid_response("Where should the sample start? (hh:mm:ss or mm:ss) ", is_valid_min_sec)
+    sample_length = get_valid_response("How long should the sample be? (hh:mm:ss or mm:ss) ", is_valid_min_sec)
+    detect_beats = True
+    if not for_batch:
+        detect_beats = get_valid_response("Detect beats here and send RR intervals to Kubios? [Y(es)/n(o), have Kubios import the acq file] ", lambda ans: ['', 'Y', 'y', 'N', 'n'].count(ans) == 1)
+        detect_beats = detect_beats == '' or detect_beats == 'Y' or detect_beats == 'y'
 
     resp['ecg_chan_label'] = ecg_chan_label
     resp['sample_start'] = sample_start
     resp['sample_length'] = sample_length
+    resp['detect_beats'] = detect_beats
     return resp
 
+def write_acq_rr_files(input_files, chan_label, skip=None):
+    """Given acq files, detects the beats in the pulse data in the channel labeled chan_label
+    in each one and writes a file with its RR intervals. Only that channel is read from each file.
+    Files for which skip(file) is true (if skip is given) are passed over.
+    This is a generator, yielding a (file name, duration (ms), None, file index) tuple for each,
+    in the form export_rr_sessions_to_kubios expects."""
+    for idx, f in enumerate(input_files):
+        if skip is not None and skip(f):
+            print("{} was completed in an earlier run; skipping.".format(PurePath(f).name))
+            continue
+        with acq.AcqFile(str(f)) as acq_file:
+            channel = acq_file.find_channel(chan_label)
+            rr = ppg.stream_rr_intervals(acq_file.iter_samples(channel), channel.sample_rate)
+        # name the RR file like the input file, since kubios names its results after it
+        rr_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(rr_dir, PurePath(f).stem + '.txt')
+            with open(fname, 'w') as rr_file:
+                rr_file.writelines("%d\n" % round(d) for d in rr)
+            yield (fname, rr.sum(), None, idx)
+        finally:
+            shutil.rmtree(rr_dir, ignore_errors=True)
+
+def check_acq_channels(input_files, chan_label, must_read):
+    """Checks every acq file has a channel labeled chan_label before starting, rather than failing
+    part way through, and exits if any doesn't. Files whose headers can't be read (e.g. compressed
+    files) also fail the check if must_read is true (i.e. we're detecting the beats ourselves);
+    otherwise they are only reported, and left for Kubios to import."""
+    failed = False
+    for f in input_files:
+        try:
+            channels = acq.scan_acq_files([str(f)])[str(f)]
+        except Exception as ex:
+            if must_read:
+                kubios.warn("Can't read {}: {}".format(f, ex))
+                failed = True
+            else:
+                kubios.warn("Can't read the channels of {} ({}); leaving it for Kubios to import.".format(f, ex))
+            continue
+        if not any(c.label.lower() == chan_label.strip().lower() for c in channels):
+            kubios.warn("{} has no channel labeled '{}'. Its channels are: {}".format(f, chan_label, ', '.join(c.label for c in channels)))
+            failed = True
+    if failed: wait_and_exit(1)
+
 def process_pulse_acq_files(input_files):
     input_params = get_pulse_acq_processing_params()
     num_files = len(input_files)
+    check_acq_channels(input_files, input_params['ecg_chan_label'], input_params['detect_beats'])
+
+    settings = {k: input_params[k] for k in ['ecg_chan_label', 'sample_start', 'sample_length', 'detect_beats']}
+    skip = lambda f: run_journal.should_skip(PurePath(f).name, settings)
+    if input_params['detect_beats']:
+        rr_files = write_acq_rr_files(input_files, input_params['ecg_chan_label'], skip)
+        export_rr_sessions_to_kubios(rr_files, num_files, output_path, input_params['sample_length'], input_params['sample_start'],
+            run_journal=run_journal, item_name=lambda rr_file: PurePath(input_files[rr_file[3]]).name, journal_settings=settings)
+        return
+
     for idx, f in enumerate(input_files):
+        item = PurePath(f).name
+        if skip(f):
+            print("{} was completed in an earlier run; skipping.".format(item))
+            continue
         f = str(f)
         print("File {} of {}...".format(idx + 1, num_files))
+        record_stage(run_journal, item, journal.EXPORTED, settings)
         already_running_ok = idx > 0
         app = safe_get_kubios(already_running_ok)
 
@@ -288,19 +616,53 @@ def process_pulse_acq_files(input_files):
         kubios.open_acq_file(app, f, input_params['ecg_chan_label'])
         kubios_window = app.window(title_re='Kubios.*$', class_name='SunAwtFrame')
         kubios.analyse(kubios_window, input_params['sample_length'], input_params['sample_start'])
+        record_stage(run_journal, item, journal.ANALYSED, settings)
         results_path = save_and_close_kubios_results(app, kubios_window, f)
-        if not kubios.expected_output_files_exist(results_path):
-            wait_and_exit(1)
+        check_output_files_exist(run_journal, item, settings, results_path)
 
         sample_start_sec = min_sec_to_sec(input_params['sample_start'])
         sample_length_sec = min_sec_to_sec(input_params['sample_length']) + sample_start_sec
         unexpected_settings = confirm_expected_settings(results_path, sample_length_sec, sample_start_sec)
-        
-        for (name, expected, actual) in unexpected_settings:
-            print("{0} should be '{1}' but is '{2}'. Please double-check Kubios and re-run.".format(name, expected, actual))
-
-        if len(unexpected_settings) > 0: wait_and_exit(2)
-
+        check_settings(run_journal, item, settings, results_path, unexpected_settings)
+
+
+def process_files_in_batch(file_type, input_files):
+    """Analyses input_files natively, without Kubios, spreading the work across a pool of
+    worker processes (see batch.process_in_batch)"""
+    if file_type == EMWAVE_FILE_TYPE:
+        sample_start = get_valid_response("Where should the sample start? (hh:mm:ss or mm:ss) [00:00] ", is_valid_min_sec)
+        sample_length = get_valid_response("How long should the sample be? (hh:mm:ss or mm:ss) [use full session] ", is_valid_min_sec)
+        params = {}
+    elif file_type == PULSE_TEXT_FILE_TYPE:
+        params = get_pulse_txt_processing_params(True)
+        (sample_start, sample_length) = (params['sample_start'], params['sample_length'])
+        params = {'layout': params}
+    else:
+        params = get_pulse_acq_processing_params(True)
+        (sample_start, sample_length) = (params['sample_start'], params['sample_length'])
+        params = {'chan_label': params['ecg_chan_label']}
+    params['sample_start'] = min_sec_to_sec(sample_start)
+    params['sample_length'] = min_sec_to_sec(sample_length)
+
+    # long recordings can also be analysed in sliding windows, over the whole recording
+    is_valid_duration = lambda ans: is_valid_min_sec(ans) and (ans == '' or min_sec_to_sec(ans) > 0)
+    window_length = get_valid_response("Also analyse each recording in sliding windows of what length? (hh:mm:ss or mm:ss) [don't] ", is_valid_duration)
+    if window_length != '':
+        window_step = get_valid_response("How far apart should the windows start? (hh:mm:ss or mm:ss) [{}] ".format(millis_to_min_sec(windowed.WINDOW_STEP * 1000)), is_valid_duration)
+        window_step = windowed.WINDOW_STEP if window_step == '' else min_sec_to_sec(window_step)
+        params['window'] = (min_sec_to_sec(window_length), window_step)
+
+    workers = get_valid_response("How many worker processes should be used? [{}] ".format(batch.default_workers()), lambda ans: ans == '' or (is_int(ans) and int(ans) > 0))
+    workers = batch.default_workers() if workers == '' else int(workers)
+    start = time.time()
+    (num_rows, num_checked, coherence_mismatches) = batch.process_in_batch(file_type, input_files, output_path, params, workers)
+    print("Analysed {} recordings in {:.1f}s; results are in {}.".format(num_rows, time.time() - start, output_path / batch.BATCH_RESULTS_FILE_NAME))
+    if coherence_mismatches:
+        (source, session, emwave_value, native_value) = coherence_mismatches[0]
+        kubios.warn("The native coherence is more than {:.0%} from emWave's AvgCoherence for {} of {} sessions (e.g. {} session {}: emWave {}, native {}); see the coherence and emwave_coherence columns.".format(
+            coherence.EMWAVE_TOLERANCE, len(coherence_mismatches), num_checked, source, session, emwave_value, native_value))
+    if 'window' in params:
+        print("Sliding-window results are in {}.".format(output_path / batch.BATCH_WINDOWS_FILE_NAME))
 
 def make_output_dir_if_not_exists(input_dir):
     input_path = Path(input_dir)
@@ -325,10 +687,11 @@ def get_valid_response(msg, valid_response_fn):
         return resp
 
 def is_valid_min_sec(input):
-    """Returns true if input is empty or in the form mm:ss or :ss, 
-    where mm and ss are between 0 and 59"""
+    """Returns true if input is empty or in the form hh:mm:ss, mm:ss or :ss,
+    where mm and ss are between 0 and 59 (hh may be any number of hours)"""
     if input == '': return True
     parts = input.split(':')
+    if len(parts) > 3: return False
     try:
         if len(parts) == 1:
             secs = int(parts[0])
@@ -338,15 +701,18 @@ def is_valid_min_sec(input):
             secs = int(parts[1])
             return 0 <= secs <= 59 and 0 <= mins <= 59
         else:
-            return False # hours are not supported
+            hours = int(parts[0])
+            mins = int(parts[1])
+            secs = int(parts[2])
+            return 0 <= secs <= 59 and 0 <= mins <= 59 and 0 <= hours
     except ValueError:
         return False
 
 def min_sec_to_sec(min_sec):
     """Given an empty string, returns None.
-       Given a string in the form mm:ss, returns the total number of seconds it represents."""
+       Given a string in the form hh:mm:ss or mm:ss, returns the total number of seconds it represents."""
     if not is_valid_min_sec(min_sec):
-        print("{} is not a valid minutes/seconds (mm:ss) value".format(min_sec))
+        print("{} is not a valid hours/minutes/seconds (hh:mm:ss or mm:ss) value".format(min_sec))
         wait_and_exit(0)
 
     if min_sec == '': return None
@@ -355,37 +721,55 @@ def min_sec_to_sec(min_sec):
     secs = int(parts[0])
     if len(parts) > 1:
         secs += int(parts[1]) * 60
+    if len(parts) > 2:
+        secs += int(parts[2]) * 3600
 
     return secs
 
 def millis_to_min_sec(millis):
-    """Given a number of milliseconds, returns an mm:ss string"""
-    if millis > 3600000:
-        print("Session durations longer than an hour are not supported.\n")
-        raise ValueError
-       
-    if millis > 60000:
-        minutes = (millis % 3600000) // 60000
-        seconds = (millis - (minutes * 60000)) // 1000
-    else:
-        minutes = 0
-        seconds = millis // 1000
+    """Given a number of milliseconds, returns an mm:ss string, or an hh:mm:ss
+    string if it's an hour or more"""
+    total_secs = int(millis) // 1000
+    (hours, secs) = divmod(total_secs, 3600)
+    (minutes, seconds) = divmod(secs, 60)
+    if hours > 0:
+        return "{:02d}:{:02d}:{:02d}".format(hours, minutes, seconds)
 
     return "{:02d}:{:02d}".format(minutes, seconds)
 
+def open_run_journal(output_path):
+    """Opens the run journal in output_path. If earlier runs left records in it, asks
+    the user whether to resume, skipping the items they completed."""
+    run_journal = journal.RunJournal(output_path).open()
+    (num_verified, num_failed, num_incomplete) = run_journal.summary()
+    if num_verified + num_failed + num_incomplete > 0:
+        print("Earlier runs in {} completed {} items; {} failed and {} were left incomplete.".format(output_path, num_verified, num_failed, num_incomplete))
+        resume = get_valid_response("Resume, skipping the completed items? [Y(es)/n(o), redo everything] ", lambda resp: ['', 'Y', 'y', 'N', 'n'].count(resp) > 0)
+        run_journal.resume = resume == '' or resume == 'Y' or resume == 'y'
+    return run_journal
+
 def wait_and_exit(code):
     """Prompts the user and waits for response before closing output window"""
     input("Press the Enter key when you're ready to close the window...")
     sys.exit(code)
 
 if __name__ == "__main__":
+    # needed for worker processes in the frozen (pyinstaller) build on Windows
+    multiprocessing.freeze_support()
     try:
         (file_type, input_dir) = get_run_info()
         output_path = make_output_dir_if_not_exists(input_dir)
+        if file_type == VERIFY_OUTPUT_RUN_TYPE:
+            wait_and_exit(0 if verify_output(output_path) == 0 else 1)
         input_files = get_input_files(input_dir, file_type)
         if len(input_files) == 0:
             print("No files of type '{}' found in directory '{}'".format(FILE_TYPE_TO_EXTENSION[file_type], input_dir))
             wait_and_exit(0)
+        use_batch = get_valid_response("Analyse with Kubios, or natively in a batch across all cores? [K(ubios)/b(atch)] ", lambda ans: ['', 'K', 'k', 'B', 'b'].count(ans) == 1)
+        if use_batch == 'B' or use_batch == 'b':
+            process_files_in_batch(file_type, input_files)
+            wait_and_exit(0)
+        run_journal = open_run_journal(output_path)
         if file_type == EMWAVE_FILE_TYPE:
             process_emwave_files(input_files)
         elif file_type == PULSE_TEXT_FILE_TYPE:
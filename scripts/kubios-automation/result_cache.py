@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+# Suffixes of the kubios output files each cache entry holds (see results.OUTPUT_SUFFIXES)
+CACHED_SUFFIXES = ['.pdf', '.txt', '.mat']
+
+# File in each cache entry holding the summary values parsed from the .mat file
+SUMMARY_FILE_NAME = 'summary.json'
+
+# Bump this when what goes into a key or an entry changes, so that old entries are never used
+CACHE_FORMAT = 1
+
+def cache_key(rr_file, settings):
+    """Returns the key of the results for the RR data in rr_file analysed with settings
+    (a dict of e.g. sample start, sample length, AR order and artifact correction):
+    a sha256 hash of the file's contents and the settings."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'format': CACHE_FORMAT, 'settings': settings}, sort_keys=True).encode('utf-8'))
+    with open(rr_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        # e.g. the cache and output dir are on different drives, or the file system has no hard links
+        shutil.copy2(src, dest)
+
+class ResultCache:
+    """Content-addressed cache of kubios results in cache_dir. Each entry is a directory named
+    by its key (see cache_key) holding the kubios output files and a json summary of them.
+    Entries are written to a temporary directory and renamed into place, so a crash never leaves
+    a partial entry behind. When the entries add up to more than max_bytes the least recently
+    used ones are evicted (an entry's directory modification time is its last use).
+    Results are hard-linked into the output dir when possible, so output files must not be edited in place."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self._index = None
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self):
+        """Scans the cache dir (once) for the size and last use of each entry"""
+        if self._index is not None:
+            return self._index
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index = {}
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                if entry.name.startswith('tmp-'):
+                    # left over from a crash while storing an entry
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                self._index[entry.name] = (size, entry.stat().st_mtime)
+        return self._index
+
+    def get(self, key, results_path):
+        """If the cache has an entry for key, links (or copies) its output files to results_path
+        plus each suffix and returns its summary. Returns None otherwise."""
+        index = self._load_index()
+        entry_dir = self._entry_dir(key)
+        if key not in index:
+            return None
+        try:
+            with open(os.path.join(entry_dir, SUMMARY_FILE_NAME)) as f:
+                summary = json.load(f)
+            for suffix in CACHED_SUFFIXES:
+                _link_or_copy(os.path.join(entry_dir, 'result' + suffix), results_path + suffix)
+        except (OSError, ValueError):
+            # entry was removed or damaged behind our back; forget it
+            del index[key]
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        now = time.time()
+        os.utime(entry_dir, (now, now))
+        index[key] = (index[key][0], now)
+        return summary
+
+    def put(self, key, results_path, summary):
+        """Stores the output files at results_path (plus each suffix) and their summary under key,
+        then evicts least recently used entries until the cache is within max_bytes"""
+        index = self._load_index()
+        if key in index:
+            return
+        tmp_dir = self._entry_dir('tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        try:
+            size = 0
+            for suffix in CACHED_SUFFIXES:
+                dest = os.path.join(tmp_dir, 'result' + suffix)
+                shutil.copy2(results_path + suffix, dest)
+                size += os.path.getsize(dest)
+            with open(os.path.join(tmp_dir, SUMMARY_FILE_NAME), 'w') as f:
+                json.dump(summary, f)
+            size += os.path.getsize(os.path.join(tmp_dir, SUMMARY_FILE_NAME))
+            os.replace(tmp_dir, self._entry_dir(key))
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if os.path.isdir(self._entry_dir(key)):
+                return # another run stored the same results first
+            raise
+        index[key] = (size, time.time())
+        self.evict(keep=key)
+
+    def size(self):
+        return sum(size for (size, _) in self._load_index().values())
+
+    def evict(self, keep=None):
+        """Removes least recently used entries (other than keep) until the cache is within max_bytes"""
+        index = self._load_index()
+        total = self.size()
+        for key in sorted(index, key=lambda k: index[k][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= index.pop(key)[0]
@@ -0,0 +1,178 @@
+from collections import namedtuple
+from functools import reduce
+from math import gcd
+import numpy as np
+import os
+import struct
+
+# Offsets (bytes) of the fields we use in the graph header, which starts the file,
+# and in each channel header. Layouts are those of uncompressed AcqKnowledge files.
+GRAPH_VERSION_OFFSET = 2 # lVersion, int32
+GRAPH_HEADER_LEN_OFFSET = 6 # lExtItemHeaderLen, int32
+GRAPH_CHANNELS_OFFSET = 10 # nChannels, int16
+GRAPH_SAMPLE_TIME_OFFSET = 16 # dSampleTime (ms per sample), double
+
+CHANNEL_HEADER_LEN_OFFSET = 0 # lChanHeaderLen, int32
+CHANNEL_LABEL_OFFSET = 6 # szCommentText, char[40]
+CHANNEL_UNITS_OFFSET = 68 # szUnitsText, char[20]
+CHANNEL_NUM_SAMPLES_OFFSET = 88 # lBufLength, int32
+CHANNEL_SCALE_OFFSET = 92 # dAmplScale, double
+CHANNEL_AMPL_OFFSET_OFFSET = 100 # dAmplOffset, double
+CHANNEL_DIVIDER_OFFSET = 250 # nVarSampleDivider, int16 (version 38 and later)
+
+# File versions from which channels may have sample dividers, and from which the
+# foreign data header's length is stored as an int32 rather than an int16
+DIVIDER_VERSION = 38
+LONG_FOREIGN_LENGTH_VERSION = 68
+
+# Sample data types, by the nType in each channel's data type header
+DATA_TYPES = {1: 'f8', 2: 'i2'}
+
+# Number of samples of a channel read from the file at a time
+CHUNK_SAMPLES = 1000000
+
+AcqChannel = namedtuple('AcqChannel', ['index', 'label', 'units', 'num_samples', 'sample_rate', 'divider', 'dtype', 'scale', 'offset'])
+
+def _cstring(raw):
+    return raw.split(b'\0', 1)[0].decode('latin-1').strip()
+
+class AcqFile:
+    """Reader for BIOPAC AcqKnowledge (.acq) files. Opening the file reads only the graph header,
+    the channel headers and the channel data types; samples are read from a memory map of the file,
+    one channel (and chunk_samples of it) at a time, so the other channels are never loaded.
+    Channels are interleaved in the file; a channel with a sample divider of d has a sample on
+    every d-th tick of the base sample clock. Compressed files are not supported."""
+
+    def __init__(self, acq_file_path):
+        self.path = acq_file_path
+        self.channels = []
+        self._data = None
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            graph = f.read(GRAPH_SAMPLE_TIME_OFFSET + 8)
+            # files written on Macs are big-endian; a sane version number tells us which we have
+            self.byte_order = '<'
+            if not 0 < struct.unpack_from('<l', graph, GRAPH_VERSION_OFFSET)[0] < 1000:
+                self.byte_order = '>'
+            (self.version, graph_len) = self._unpack(graph, GRAPH_VERSION_OFFSET, 'll')
+            (num_channels,) = self._unpack(graph, GRAPH_CHANNELS_OFFSET, 'h')
+            (sample_time,) = self._unpack(graph, GRAPH_SAMPLE_TIME_OFFSET, 'd')
+            base_rate = 1000.0 / sample_time
+
+            offset = graph_len
+            headers = []
+            for _ in range(num_channels):
+                f.seek(offset)
+                (header_len,) = self._unpack(f.read(4), CHANNEL_HEADER_LEN_OFFSET, 'l')
+                f.seek(offset)
+                headers.append(f.read(header_len))
+                offset += header_len
+
+            f.seek(offset)
+            foreign_format = 'l' if self.version >= LONG_FOREIGN_LENGTH_VERSION else 'h'
+            (foreign_len,) = self._unpack(f.read(4), 0, foreign_format)
+            offset += foreign_len
+            f.seek(offset)
+            type_headers = f.read(4 * num_channels)
+            self.data_start = offset + 4 * num_channels
+
+        for (i, header) in enumerate(headers):
+            (num_samples,) = self._unpack(header, CHANNEL_NUM_SAMPLES_OFFSET, 'l')
+            (scale, ampl_offset) = self._unpack(header, CHANNEL_SCALE_OFFSET, 'dd')
+            divider = 1
+            if self.version >= DIVIDER_VERSION and len(header) >= CHANNEL_DIVIDER_OFFSET + 2:
+                divider = max(1, self._unpack(header, CHANNEL_DIVIDER_OFFSET, 'h')[0])
+            (_, data_type) = self._unpack(type_headers, 4 * i, 'hh')
+            if data_type not in DATA_TYPES:
+                raise Exception('Channel {} of {} has unknown data type {}; is the file compressed?'.format(i, self.path, data_type))
+            self.channels.append(AcqChannel(
+                i,
+                _cstring(header[CHANNEL_LABEL_OFFSET:CHANNEL_LABEL_OFFSET + 40]),
+                _cstring(header[CHANNEL_UNITS_OFFSET:CHANNEL_UNITS_OFFSET + 20]),
+                num_samples,
+                base_rate / divider,
+                divider,
+                np.dtype(self.byte_order + DATA_TYPES[data_type]),
+                scale,
+                ampl_offset))
+        self._layout()
+        return self
+
+    def _unpack(self, buffer, offset, fmt):
+        return struct.unpack_from(self.byte_order + fmt, buffer, offset)
+
+    def _layout(self):
+        """Works out where each channel's samples sit within one period of the interleaving
+        pattern (the least common multiple of the sample dividers, in base clock ticks)"""
+        dividers = [c.divider for c in self.channels]
+        period = reduce(lambda a, b: a * b // gcd(a, b), dividers, 1)
+        self._sample_offsets = [[] for _ in self.channels]
+        position = 0
+        for tick in range(period):
+            for c in self.channels:
+                if tick % c.divider == 0:
+                    self._sample_offsets[c.index].append(position)
+                    position += c.dtype.itemsize
+        self._period_bytes = position
+        self._sample_offsets = [np.array(o, dtype=np.int64) for o in self._sample_offsets]
+
+        data_bytes = os.path.getsize(self.path) - self.data_start
+        for c in self.channels:
+            if c.num_samples > 0 and self._byte_offsets(c, np.array([c.num_samples - 1]))[0] + c.dtype.itemsize > data_bytes:
+                raise Exception('{} is shorter than its headers say; it may be compressed, which is not supported.'.format(self.path))
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def find_channel(self, label):
+        """Returns the channel whose label is label (ignoring case and surrounding spaces if there's no exact match)"""
+        for c in self.channels:
+            if c.label == label:
+                return c
+        for c in self.channels:
+            if c.label.lower() == label.strip().lower():
+                return c
+        raise Exception('{} has no channel labeled "{}". Its channels are: {}'.format(self.path, label, ', '.join(c.label for c in self.channels)))
+
+    def _byte_offsets(self, channel, sample_idx):
+        offsets = self._sample_offsets[channel.index]
+        (periods, within) = np.divmod(sample_idx, len(offsets))
+        return periods * self._period_bytes + offsets[within]
+
+    def iter_samples(self, channel, chunk_samples=CHUNK_SAMPLES):
+        """Yields the (scaled) samples of channel, chunk_samples at a time.
+        int16 data is scaled by the channel's amplitude scale and offset; doubles are stored scaled."""
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='r', offset=self.data_start)
+        item_size = channel.dtype.itemsize
+        for start in range(0, channel.num_samples, chunk_samples):
+            idx = np.arange(start, min(start + chunk_samples, channel.num_samples))
+            byte_idx = self._byte_offsets(channel, idx)[:, None] + np.arange(item_size)
+            raw = self._data[byte_idx].view(channel.dtype).ravel()
+            if channel.dtype.kind == 'i':
+                yield raw * channel.scale + channel.offset
+            else:
+                yield raw.astype(np.float64)
+
+    def read_channel(self, channel):
+        """Returns all of the (scaled) samples of channel"""
+        chunks = list(self.iter_samples(channel))
+        if not chunks:
+            return np.zeros(0)
+        return np.concatenate(chunks)
+
+def scan_acq_files(acq_file_paths):
+    """Returns a dict of file path -> list of AcqChannel for each of the given .acq files.
+    Only the headers are read, so this is quick even for large recordings."""
+    channels = {}
+    for path in acq_file_paths:
+        with AcqFile(path) as acq_file:
+            channels[path] = acq_file.channels
+    return channels
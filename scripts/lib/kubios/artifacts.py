@@ -0,0 +1,112 @@
+import numpy as np
+from scipy.interpolate import CubicSpline
+from scipy.ndimage import median_filter, percentile_filter
+
+# Parameters of the automatic beat detection algorithm Kubios' "Automatic correction"
+# is based on (Lipponen & Tarvainen 2019)
+THRESHOLD_WINDOW = 91 # beats used to compute the time-varying thresholds
+THRESHOLD_SCALE = 5.2 # multiple of the quartile deviation used as the threshold
+MEDIAN_WINDOW = 11 # beats in the median filter used to compute mRR
+ECTOPIC_C1 = 0.13
+ECTOPIC_C2 = 0.17
+LONG_SHORT_MRR_LIMIT = 3.0
+
+def _quartile_deviation_threshold(x):
+    """Returns THRESHOLD_SCALE times the rolling quartile deviation of |x|"""
+    abs_x = np.abs(x)
+    q1 = percentile_filter(abs_x, 25, size=THRESHOLD_WINDOW, mode='nearest')
+    q3 = percentile_filter(abs_x, 75, size=THRESHOLD_WINDOW, mode='nearest')
+    threshold = THRESHOLD_SCALE * (q3 - q1) / 2.0
+    # a perfectly regular stretch of beats has zero deviation; don't divide by zero
+    return np.maximum(threshold, np.finfo(np.float64).eps)
+
+def detect_artifacts(rr):
+    """Given RR intervals (ms), returns a dict of boolean arrays (one element per beat) flagging
+    'ectopic', 'missed', 'extra' and 'long_short' beats. Beats are classified from the successive
+    differences (dRR) and the deviation from the 11-beat median (mRR), each normalized by a rolling
+    threshold, using only whole-array rolling-median/percentile filters and comparisons."""
+    rr = np.asarray(rr, dtype=np.float64)
+    n = len(rr)
+    flags = {name: np.zeros(n, dtype=bool) for name in ['ectopic', 'missed', 'extra', 'long_short']}
+    if n < 3:
+        return flags
+
+    drr = np.diff(rr, prepend=rr[0])
+    th1 = _quartile_deviation_threshold(drr)
+    drr = drr / th1
+
+    med_rr = median_filter(rr, size=MEDIAN_WINDOW, mode='nearest')
+    mrr = rr - med_rr
+    mrr[mrr < 0] *= 2.0
+    th2 = _quartile_deviation_threshold(mrr)
+    nmrr = mrr / th2
+
+    padded = np.concatenate(([0.0], drr, [0.0, 0.0]))
+    prev_drr = padded[:-3]
+    next_drr = padded[2:-1]
+    next2_drr = padded[3:]
+
+    # ectopic beats: a large jump followed (or preceded) by a large jump the other way
+    s12 = np.where(drr > 0, np.maximum(prev_drr, next_drr), np.minimum(prev_drr, next_drr))
+    ectopic = ((drr > 1) & (s12 < -ECTOPIC_C1 * drr - ECTOPIC_C2)) | ((drr < -1) & (s12 > -ECTOPIC_C1 * drr + ECTOPIC_C2))
+
+    # long and short beats
+    s22 = np.where(drr >= 0, np.minimum(next_drr, next2_drr), np.maximum(next_drr, next2_drr))
+    long_short = ((drr < -1) & (s22 > 1)) | ((drr > 1) & (s22 < -1)) | (np.abs(nmrr) > LONG_SHORT_MRR_LIMIT)
+    long_short &= ~ectopic
+
+    # a long beat that's about twice the median is a missed beat; a short beat that,
+    # added to the next one, is about the median is an extra beat
+    missed = long_short & (np.abs(rr / 2.0 - med_rr) < th2)
+    next_rr = np.append(rr[1:], np.inf)
+    extra = long_short & ~missed & (np.abs(rr + next_rr - med_rr) < th2)
+    long_short &= ~(missed | extra)
+    # the beat after an extra beat absorbs it when corrected, so isn't an artifact itself
+    long_short[1:] &= ~extra[:-1]
+
+    flags['ectopic'] = ectopic
+    flags['missed'] = missed
+    flags['extra'] = extra
+    flags['long_short'] = long_short
+    return flags
+
+def correct_artifacts(rr, flags=None):
+    """Given RR intervals (ms), returns (corrected RR intervals, percentage of beats corrected).
+    Missed beats are split in two, extra beats are merged with the following beat, and
+    ectopic and long/short beats are replaced by cubic spline interpolation over the
+    surrounding good beats. flags is the output of detect_artifacts; it is computed if not given."""
+    rr = np.asarray(rr, dtype=np.float64)
+    if flags is None:
+        flags = detect_artifacts(rr)
+    n = len(rr)
+    num_corrected = int(sum(np.count_nonzero(f) for f in flags.values()))
+    if num_corrected == 0 or n == 0:
+        return (rr.copy(), 0.0)
+
+    # merge each extra beat into the beat after it
+    extra = flags['extra'].copy()
+    extra[-1] = False
+    merged = rr.copy()
+    merged[1:][extra[:-1]] += rr[:-1][extra[:-1]]
+    keep = ~extra
+    merged = merged[keep]
+    bad = (flags['ectopic'] | flags['long_short'])[keep]
+    missed = flags['missed'][keep]
+
+    # split each missed beat into two
+    counts = np.where(missed, 2, 1)
+    corrected = np.repeat(merged / counts, counts)
+    bad = np.repeat(bad, counts)
+
+    good = np.flatnonzero(~bad)
+    if bad.any() and len(good) >= 2:
+        idx = np.arange(len(corrected))
+        corrected[bad] = CubicSpline(good, corrected[good])(idx[bad])
+
+    return (corrected, 100.0 * num_corrected / n)
+
+def correct_artifacts_batch(rr_series):
+    """Applies correct_artifacts to each of the RR interval series in rr_series.
+    Returns (list of corrected series, array of percentages of beats corrected)."""
+    results = [correct_artifacts(rr) for rr in rr_series]
+    return ([r[0] for r in results], np.array([r[1] for r in results]))
@@ -0,0 +1,134 @@
+import hrv
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+from scipy.interpolate import CubicSpline
+
+# Coherence is computed over a rolling window of the resampled tachogram (the HeartMath
+# defaults: a 64s window, updated every 5s)
+RESAMPLE_RATE = 4.0 # Hz
+WINDOW_LENGTH = 64 # seconds
+WINDOW_STEP = 5 # seconds
+
+# Frequency ranges (Hz): the band total power is measured over, the band the peak is looked
+# for in and the width of the range around the peak that counts as peak power
+TOTAL_BAND = (0.0033, 0.4)
+PEAK_BAND = (0.04, 0.26)
+PEAK_WIDTH = 0.030
+
+# Number of windows transformed at once; bounds the size of the buffers CoherenceEngine reuses
+CHUNK_WINDOWS = 256
+
+# How far (relative) our average coherence may be from emWave's AvgCoherence before it's reported;
+# emWave's exact score scaling isn't documented, so this is loose
+EMWAVE_TOLERANCE = 0.1
+
+def coherence_score(ratio):
+    """Converts coherence ratios to the (logarithmic) coherence score emWave reports"""
+    return np.log(ratio + 1.0)
+
+class CoherenceEngine:
+    """Computes HeartMath-style coherence from RR intervals. For each window the peak in PEAK_BAND
+    is found, and the coherence ratio is (peak power / (total power - peak power))^2, where peak power is
+    the power within PEAK_WIDTH of the peak and total power is the power in TOTAL_BAND.
+    The whole session is resampled once, windows are strided views onto it, and they are
+    transformed CHUNK_WINDOWS at a time with a single batched FFT. The buffers the windows are
+    copied into are allocated once and reused for every chunk and every session the engine scores."""
+
+    def __init__(self, fs=RESAMPLE_RATE, window_length=WINDOW_LENGTH, step=WINDOW_STEP, chunk_windows=CHUNK_WINDOWS):
+        self.fs = fs
+        self.window_samples = int(round(window_length * fs))
+        self.step_samples = max(1, int(round(step * fs)))
+        self.chunk_windows = chunk_windows
+        self.freqs = fft.rfftfreq(self.window_samples, 1.0 / fs)
+        self.window = np.hanning(self.window_samples)
+        self.buffer = np.empty((chunk_windows, self.window_samples))
+        self.power = np.empty((chunk_windows, len(self.freqs)))
+
+        total = np.flatnonzero((self.freqs >= TOTAL_BAND[0]) & (self.freqs <= TOTAL_BAND[1]))
+        self.total_slice = slice(total[0], total[-1] + 1)
+        self.peak_bins = np.flatnonzero((self.freqs >= PEAK_BAND[0]) & (self.freqs <= PEAK_BAND[1]))
+        df = self.freqs[1]
+        # the bins within PEAK_WIDTH / 2 of each possible peak bin
+        half_width = int(round(PEAK_WIDTH / 2.0 / df))
+        self.peak_lo = np.maximum(self.peak_bins - half_width, 0)
+        self.peak_hi = np.minimum(self.peak_bins + half_width + 1, len(self.freqs))
+
+    def tachogram(self, rr):
+        """Returns the RR intervals (ms) resampled at fs Hz, or an empty array if there are too few"""
+        rr = np.asarray(rr, dtype=np.float64)
+        if len(rr) < 4:
+            return np.zeros(0)
+        t = hrv.beat_times(rr)
+        return CubicSpline(t, rr)(np.arange(t[0], t[-1], 1.0 / self.fs))
+
+    def _ratios(self, windows):
+        n = len(windows)
+        buffer = self.buffer[:n]
+        power = self.power[:n]
+        np.subtract(windows, windows.mean(axis=1, keepdims=True), out=buffer)
+        np.multiply(buffer, self.window, out=buffer)
+        spectra = fft.rfft(buffer, axis=1, workers=-1)
+        np.abs(spectra, out=power)
+        np.square(power, out=power)
+
+        total_power = power[:, self.total_slice].sum(axis=1)
+        cumulative = np.concatenate((np.zeros((n, 1)), np.cumsum(power, axis=1)), axis=1)
+        peak = np.argmax(power[:, self.peak_bins], axis=1)
+        rows = np.arange(n)
+        peak_power = cumulative[rows, self.peak_hi[peak]] - cumulative[rows, self.peak_lo[peak]]
+        other_power = total_power - peak_power
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(other_power > 0, (peak_power / other_power) ** 2, np.nan)
+
+    def ratios(self, rr):
+        """Returns (start times (s, from the first beat), coherence ratios) for every complete window"""
+        x = self.tachogram(rr)
+        if len(x) < self.window_samples:
+            return (np.zeros(0), np.zeros(0))
+        windows = sliding_window_view(x, self.window_samples)[::self.step_samples]
+        ratios = np.empty(len(windows))
+        for first in range(0, len(windows), self.chunk_windows):
+            chunk = windows[first:first + self.chunk_windows]
+            ratios[first:first + len(chunk)] = self._ratios(chunk)
+        return (np.arange(len(windows)) * self.step_samples / self.fs, ratios)
+
+    def scores(self, rr):
+        """Returns (start times (s), coherence scores) for every complete window"""
+        (starts, ratios) = self.ratios(rr)
+        return (starts, coherence_score(ratios))
+
+    def average(self, rr):
+        """Returns the mean coherence score over the session, or NaN if it's shorter than a window"""
+        (_, scores) = self.scores(rr)
+        if len(scores) == 0:
+            return np.nan
+        return np.nanmean(scores)
+
+def average_coherence_batch(rr_series, engine=None):
+    """Returns an array with the average coherence score (see CoherenceEngine.average)
+    of each of the RR interval series (ms) in rr_series. All of them share one engine's buffers."""
+    if engine is None:
+        engine = CoherenceEngine()
+    return np.array([engine.average(rr) for rr in rr_series])
+
+def emwave_mismatches(native_values, emwave_values, rel_tolerance=EMWAVE_TOLERANCE):
+    """Given the average coherence we computed for some sessions and emWave's AvgCoherence for the
+    same sessions, returns an empty list if each of ours is within rel_tolerance of emWave's, and a
+    list of (session index, emwave_value, native_value) tuples if not.
+    Sessions without an AvgCoherence are skipped."""
+    mismatches = []
+    for (i, (native_value, emwave_value)) in enumerate(zip(native_values, emwave_values)):
+        if emwave_value is None:
+            continue
+        if not np.isclose(native_value, emwave_value, rtol=rel_tolerance):
+            mismatches.append((i, emwave_value, native_value))
+    return mismatches
+
+def compare_with_emwave(sessions, rel_tolerance=EMWAVE_TOLERANCE, engine=None):
+    """Given emWave sessions (anything with rr_data and avg_coherence, e.g. emwave.Session),
+    computes the average coherence of each one and compares it with emWave's AvgCoherence
+    (see emwave_mismatches)"""
+    sessions = list(sessions)
+    native = average_coherence_batch([s.rr_data for s in sessions], engine)
+    return emwave_mismatches(native, [s.avg_coherence for s in sessions], rel_tolerance)
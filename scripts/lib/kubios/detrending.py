@@ -0,0 +1,51 @@
+import numpy as np
+from scipy.linalg import solveh_banded
+
+# Regularization parameter for smoothness priors detrending (the kubios default)
+SMOOTHNESS_PRIORS_LAMBDA = 500
+
+# Coefficients of the second-difference operator
+_SECOND_DIFF = np.array([1.0, -2.0, 1.0])
+
+def second_difference_gram(n):
+    """Returns the three non-zero diagonals (main, first off-diagonal, second off-diagonal)
+    of D2'D2, where D2 is the (n-2) x n second-difference matrix. D2'D2 is symmetric and
+    pentadiagonal, so these fully describe it."""
+    if n < 3:
+        raise ValueError('Series must have at least three samples to be detrended.')
+    diagonals = [np.zeros(n), np.zeros(n - 1), np.zeros(n - 2)]
+    # each row of D2 contributes its outer product [1, -2, 1]' [1, -2, 1] along the diagonal
+    for offset in range(3):
+        for k in range(3 - offset):
+            diagonals[offset][k:k + n - 2] += _SECOND_DIFF[k] * _SECOND_DIFF[k + offset]
+    return diagonals
+
+def smoothness_priors_trend(x, lam=SMOOTHNESS_PRIORS_LAMBDA):
+    """Returns the smoothness priors trend of each row of x (a 2d array of equal-length series):
+    the solution of (I + lam^2 D2'D2) trend = x. Rather than inverting that n x n matrix,
+    we hand its banded (pentadiagonal) form to a banded Cholesky solver, which takes linear time
+    and memory. All of the rows are solved together as multiple right-hand sides."""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    n = x.shape[1]
+    (d0, d1, d2) = second_difference_gram(n)
+    lam_sq = float(lam) ** 2
+    # upper form banded storage: ab[2 + i - j, j] == A[i, j]
+    ab = np.zeros((3, n))
+    ab[2] = 1.0 + lam_sq * d0
+    ab[1, 1:] = lam_sq * d1
+    ab[0, 2:] = lam_sq * d2
+    return solveh_banded(ab, x.T, overwrite_ab=True, check_finite=False).T
+
+def smoothness_priors(x, lam=SMOOTHNESS_PRIORS_LAMBDA):
+    """Removes the smoothness priors trend (see smoothness_priors_trend) from each row of x
+    and returns the result"""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    return x - smoothness_priors_trend(x, lam)
+
+def linear(x):
+    """Removes a linear trend from each row of x (a 2d array of equal-length series)"""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    n = x.shape[1]
+    t = np.arange(n) - (n - 1) / 2.0
+    slope = (x @ t) / (t @ t)
+    return x - x.mean(axis=1, keepdims=True) - np.outer(slope, t)
@@ -0,0 +1,105 @@
+import numpy as np
+import results
+
+# Number of beats Kubios averages over when computing min and max HR
+MIN_MAX_HR_BEATS = 5
+
+# Names of the statistics we compute, as they appear in Res.HRV.Statistics
+STAT_NAMES = ['mean_RR', 'SDNN', 'mean_HR', 'min_HR', 'max_HR', 'RMSSD']
+
+def beat_times(rr):
+    """Given RR intervals (ms), returns the time (s) at which each beat occurred,
+    using the same convention as Kubios: the first beat happens one RR interval
+    after the start of the recording."""
+    return np.cumsum(np.asarray(rr, dtype=np.float64)) / 1000.0
+
+def sample_window(rr, sample_start=None, sample_length=None):
+    """Given RR intervals (ms), returns the ones whose beats fall within the sample
+    that kubios.analyse would select. sample_start and sample_length are in seconds;
+    None means the start of the recording and the rest of the recording, respectively."""
+    rr = np.asarray(rr, dtype=np.float64)
+    if sample_start is None and sample_length is None:
+        return rr
+    t = beat_times(rr)
+    start = 0.0 if sample_start is None else sample_start
+    end = np.inf if sample_length is None else start + sample_length
+    lo, hi = np.searchsorted(t, [start, end], side='left')
+    return rr[lo:hi]
+
+def time_domain(rr, sample_start=None, sample_length=None, min_max_beats=MIN_MAX_HR_BEATS):
+    """Returns a dict of time-domain statistics for a single series of RR intervals (ms).
+    mean_RR and RMSSD are in ms (note that Kubios stores RMSSD in seconds) and SDNN
+    is in ms; the HR statistics are in beats/min.
+    See sample_window for sample_start and sample_length."""
+    stats = time_domain_batch([rr], sample_start, sample_length, min_max_beats)
+    return {k: v[0] for (k, v) in stats.items()}
+
+def time_domain_batch(rr_series, sample_start=None, sample_length=None, min_max_beats=MIN_MAX_HR_BEATS):
+    """Returns a dict of statistic name -> array with one value per series in rr_series,
+    where rr_series is a sequence of RR interval series (ms), which may differ in length.
+    All of the series are concatenated and reduced segment-by-segment, so there is no
+    per-series or per-beat Python work. Series with fewer than two beats in the sample get NaN.
+    See time_domain for units and sample_window for sample_start and sample_length."""
+    windows = [sample_window(rr, sample_start, sample_length) for rr in rr_series]
+    lengths = np.array([len(w) for w in windows], dtype=np.int64)
+    n_series = len(windows)
+    stats = {name: np.full(n_series, np.nan) for name in STAT_NAMES}
+    valid = lengths >= 2
+    if not valid.any():
+        return stats
+
+    windows = [w for (w, ok) in zip(windows, valid) if ok]
+    lengths = lengths[valid]
+    rr = np.concatenate(windows)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    sums = np.add.reduceat(rr, starts)
+    mean_rr = sums / lengths
+    sq_dev = (rr - np.repeat(mean_rr, lengths)) ** 2
+    sdnn = np.sqrt(np.add.reduceat(sq_dev, starts) / (lengths - 1))
+
+    # successive differences, ignoring the differences that span two series
+    diffs_sq = np.diff(rr) ** 2
+    diff_sums = np.add.reduceat(np.append(diffs_sq, 0.0), starts)
+    boundaries = starts[1:] - 1
+    diff_sums[:-1] -= diffs_sq[boundaries]
+    rmssd = np.sqrt(diff_sums / (lengths - 1))
+
+    hr = 60000.0 / rr
+    mean_hr = np.add.reduceat(hr, starts) / lengths
+
+    # min/max HR come from a moving average over min_max_beats beats (or the whole
+    # series, if it's shorter than that), computed within each series via cumulative sums
+    k = np.minimum(lengths, min_max_beats)
+    hr_cumsum = np.concatenate(([0.0], np.cumsum(hr)))
+    seg_id = np.repeat(np.arange(len(lengths)), lengths)
+    pos = np.arange(len(hr)) - np.repeat(starts, lengths)
+    k_per_beat = k[seg_id]
+    has_full_window = pos >= k_per_beat - 1
+    end_idx = np.arange(len(hr))[has_full_window] + 1
+    moving_avg = (hr_cumsum[end_idx] - hr_cumsum[end_idx - k_per_beat[has_full_window]]) / k_per_beat[has_full_window]
+    ma_starts = np.concatenate(([0], np.cumsum(lengths - k + 1)[:-1]))
+    min_hr = np.minimum.reduceat(moving_avg, ma_starts)
+    max_hr = np.maximum.reduceat(moving_avg, ma_starts)
+
+    for (name, values) in zip(STAT_NAMES, [mean_rr, sdnn, mean_hr, min_hr, max_hr, rmssd]):
+        stats[name][valid] = values
+    return stats
+
+def compare_with_kubios(matlab_results, stats, rel_tolerance=0.01):
+    """Given the matlab version of the kubios output and the time-domain stats (as returned by
+    time_domain) for the same RR data, returns an empty list if every statistic Kubios reported
+    is within rel_tolerance of ours, and a list of (stat_name, kubios_value, native_value) tuples if not."""
+    mismatches = []
+    with results.KubiosResults(matlab_results) as kubios_results:
+        for name in ['mean_HR', 'min_HR', 'max_HR', 'RMSSD']:
+            stat_path = 'Res/HRV/Statistics/' + name
+            if not kubios_results.has(stat_path):
+                continue
+            kubios_value = kubios_results.scalar(stat_path)
+            if name == 'RMSSD':
+                kubios_value = kubios_value * 1000 # kubios stores RMSSD in seconds
+            native_value = stats[name]
+            if not np.isclose(native_value, kubios_value, rtol=rel_tolerance):
+                mismatches.append((name, kubios_value, native_value))
+    return mismatches
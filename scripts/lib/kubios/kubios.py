@@ -1,13 +1,13 @@
 from colorama import init
 init(autoreset=True)
 from datetime import datetime
-import h5py
 import os
 from pywinauto.application import Application
 from pywinauto.findwindows import ElementNotFoundError, find_windows
 from pywinauto.win32functions import SetForegroundWindow
 from pywinauto.controls.hwndwrapper import InvalidWindowHandle
 from pywinauto.timings import TimeoutError
+import results
 import time
 
 # constants for use with open_txt_file
@@ -234,20 +234,8 @@ def close_without_saving(kubios_app):
 def get_settings(matlab_results):
     """Given the matlab version of the kubios output, extracts some of the settings
     kubios was run with and returns them"""
-    kubios_settings = {}
-    with h5py.File(matlab_results) as file:
-        kubios_settings['ar_model'] = file['Res']['HRV']['Param']['AR_order'][()][0][0]
-        kubios_settings['artifact_correction'] = ''.join([chr(c) for c in file['Res']['HRV']['Param']['Artifact_correction'][()]])
-        kubios_settings['sample_start'] = round(file['Res']['HRV']['Param']['Segments'][0][()][0])
-        kubios_settings['sample_length'] = round(file['Res']['HRV']['Param']['Segments'][1][()][0])
-        try:
-            kubios_settings['ppg_sample_rate'] = file['Res']['CNT']['rate']['EKG'][()][0][0]
-        except KeyError:
-            # not all files will have EKG sample rate - do nothing
-            pass
-            
-
-    return kubios_settings
+    with results.KubiosResults(matlab_results) as kubios_results:
+        return kubios_results.settings()
 
 def analyse(kubios_window, sample_length='00:04:00', sample_start='00:00:30', delay=2):
     """Applies artifact correction and sets the start and length of the sample.
@@ -0,0 +1,186 @@
+import coherence
+from collections import deque
+import hrv
+import numpy as np
+import quality
+import time
+
+# Length (s) of the recent window the running statistics cover
+LIVE_WINDOW_LENGTH = 60
+
+# A beat that differs from the mean of the recent accepted beats by more than this
+# fraction of it is flagged as abrupt (and treated as an artifact)
+ABRUPT_CHANGE = 0.2
+ABRUPT_REFERENCE_BEATS = 5
+
+# Seconds of accepted beats kept for the coherence estimate, beyond the coherence window itself
+COHERENCE_MARGIN = 5
+
+class LiveHrv:
+    """Running HRV statistics for a live stream of RR intervals, fed one at a time with add().
+    RMSSD and mean, min and max HR cover the last window_length seconds of accepted beats; min and
+    max HR are of the min_max_beats-beat moving average, as in hrv.time_domain. Beats flagged as
+    artifacts (see add) are reported but left out of the statistics.
+    Every beat does a constant amount of work (amortized: each beat enters and leaves each
+    queue once) and memory is bounded by the window lengths. The coherence estimate is updated
+    each time another coherence.WINDOW_STEP seconds of beats have arrived, from the last
+    coherence.WINDOW_LENGTH seconds, which is also a fixed amount of work per update."""
+
+    def __init__(self, window_length=LIVE_WINDOW_LENGTH, min_max_beats=hrv.MIN_MAX_HR_BEATS, coherence_engine=None):
+        self.window_ms = window_length * 1000.0
+        self.min_max_beats = min_max_beats
+        self.coherence_engine = coherence_engine or coherence.CoherenceEngine()
+        self.n_beats = 0
+        self.num_artifacts = 0
+        self.coherence = np.nan
+
+        self._beats = deque() # (beat number, rr, hr) for the accepted beats in the window
+        self._window_total = 0.0 # ms
+        self._hr_sum = 0.0
+        self._diffs = deque() # (beat number, squared successive difference)
+        self._diff_sum = 0.0
+        self._last_rr = None
+        self._recent_hr = deque() # hr of the last min_max_beats accepted beats
+        self._recent_hr_sum = 0.0
+        self._reference = deque(maxlen=ABRUPT_REFERENCE_BEATS)
+        self._reference_sum = 0.0
+        # monotonic queues of (beat number, moving average HR), for the window's min and max
+        self._min_queue = deque()
+        self._max_queue = deque()
+        self._coherence_beats = deque()
+        self._coherence_total = 0.0
+        self._since_coherence = 0.0
+
+    def _flag(self, rr):
+        flags = {
+            'implausible': rr < quality.MIN_PLAUSIBLE_RR or rr > quality.MAX_PLAUSIBLE_RR,
+            'abrupt': False
+        }
+        if len(self._reference) == self._reference.maxlen:
+            reference = self._reference_sum / len(self._reference)
+            flags['abrupt'] = abs(rr - reference) > ABRUPT_CHANGE * reference
+        return flags
+
+    def add(self, rr):
+        """Adds the next RR interval (ms). Returns a dict of artifact flags for it: 'implausible'
+        (outside of quality.MIN_PLAUSIBLE_RR..quality.MAX_PLAUSIBLE_RR) and 'abrupt' (see ABRUPT_CHANGE)."""
+        rr = float(rr)
+        beat = self.n_beats
+        self.n_beats += 1
+        flags = self._flag(rr)
+        if flags['implausible'] or flags['abrupt']:
+            self.num_artifacts += 1
+            # a run of abrupt beats may be a real change in heart rate, so let them
+            # into the reference even though they're kept out of the statistics
+            if not flags['implausible']:
+                self._add_reference(rr)
+            return flags
+        self._add_reference(rr)
+
+        hr = 60000.0 / rr
+        self._beats.append((beat, rr, hr))
+        self._window_total += rr
+        self._hr_sum += hr
+        if self._last_rr is not None:
+            diff_sq = (rr - self._last_rr) ** 2
+            self._diffs.append((beat, diff_sq))
+            self._diff_sum += diff_sq
+        self._last_rr = rr
+
+        self._recent_hr.append(hr)
+        self._recent_hr_sum += hr
+        if len(self._recent_hr) > self.min_max_beats:
+            self._recent_hr_sum -= self._recent_hr.popleft()
+        if len(self._recent_hr) == self.min_max_beats:
+            moving_avg = self._recent_hr_sum / self.min_max_beats
+            while self._min_queue and self._min_queue[-1][1] >= moving_avg:
+                self._min_queue.pop()
+            self._min_queue.append((beat, moving_avg))
+            while self._max_queue and self._max_queue[-1][1] <= moving_avg:
+                self._max_queue.pop()
+            self._max_queue.append((beat, moving_avg))
+
+        self._evict()
+        self._add_coherence_beat(rr)
+        return flags
+
+    def _add_reference(self, rr):
+        if len(self._reference) == self._reference.maxlen:
+            self._reference_sum -= self._reference[0]
+        self._reference.append(rr)
+        self._reference_sum += rr
+
+    def _evict(self):
+        while self._window_total > self.window_ms and len(self._beats) > 1:
+            (beat, rr, hr) = self._beats.popleft()
+            self._window_total -= rr
+            self._hr_sum -= hr
+        first_beat = self._beats[0][0]
+        # a difference belongs to the window if both of its beats do
+        while self._diffs and self._diffs[0][0] <= first_beat:
+            self._diff_sum -= self._diffs.popleft()[1]
+        # a moving average belongs to the window if all of its beats do; since beat numbers
+        # count artifacts too, compare against the number of the oldest of its beats
+        oldest_allowed = self._beats[min(self.min_max_beats, len(self._beats)) - 1][0]
+        for queue in [self._min_queue, self._max_queue]:
+            while queue and queue[0][0] < oldest_allowed:
+                queue.popleft()
+
+    def _add_coherence_beat(self, rr):
+        self._coherence_beats.append(rr)
+        self._coherence_total += rr
+        keep_ms = (coherence.WINDOW_LENGTH + COHERENCE_MARGIN) * 1000.0
+        while self._coherence_total - self._coherence_beats[0] > keep_ms:
+            self._coherence_total -= self._coherence_beats.popleft()
+        self._since_coherence += rr
+        if self._since_coherence >= coherence.WINDOW_STEP * 1000.0:
+            self._since_coherence = 0.0
+            (_, scores) = self.coherence_engine.scores(np.fromiter(self._coherence_beats, dtype=np.float64))
+            if len(scores) > 0:
+                self.coherence = scores[-1]
+
+    @property
+    def rmssd(self):
+        if not self._diffs:
+            return np.nan
+        return np.sqrt(self._diff_sum / len(self._diffs))
+
+    @property
+    def mean_hr(self):
+        if not self._beats:
+            return np.nan
+        return self._hr_sum / len(self._beats)
+
+    @property
+    def min_hr(self):
+        return self._min_queue[0][1] if self._min_queue else self.mean_hr
+
+    @property
+    def max_hr(self):
+        return self._max_queue[0][1] if self._max_queue else self.mean_hr
+
+    def snapshot(self):
+        """Returns a dict of the current values of the running statistics"""
+        return {
+            'n_beats': self.n_beats,
+            'num_artifacts': self.num_artifacts,
+            'RMSSD': self.rmssd,
+            'mean_HR': self.mean_hr,
+            'min_HR': self.min_hr,
+            'max_HR': self.max_hr,
+            'coherence': self.coherence
+        }
+
+def replay(rr_data, calculator=None, speed=None, sleep=time.sleep):
+    """Feeds stored RR intervals (ms), e.g. the rr_data of an emwave.Session decoded from LiveIBI,
+    to calculator (a new LiveHrv if not given) one at a time, as a live feed would.
+    If speed is given, waits each beat's RR interval divided by speed between beats
+    (so speed=10 replays ten times faster than real time); otherwise it doesn't wait.
+    This is a generator, yielding (rr, artifact flags, calculator.snapshot()) for each beat."""
+    if calculator is None:
+        calculator = LiveHrv()
+    for rr in rr_data:
+        if speed:
+            sleep(rr / 1000.0 / speed)
+        flags = calculator.add(rr)
+        yield (rr, flags, calculator.snapshot())
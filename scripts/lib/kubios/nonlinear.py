@@ -0,0 +1,133 @@
+import hrv
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Entropy parameters (the kubios defaults): embedding dimension and tolerance,
+# the latter as a multiple of the standard deviation of the RR intervals
+ENTROPY_DIMENSION = 2
+ENTROPY_TOLERANCE = 0.2
+
+# Box sizes (in beats) DFA short-term (alpha1) and long-term (alpha2) fluctuations are fitted over
+DFA_ALPHA1_RANGE = (4, 16)
+DFA_ALPHA2_RANGE = (16, 64)
+
+# Names of the metrics we compute, as they appear in Res.HRV.NonLinear
+METRIC_NAMES = ['SD1', 'SD2', 'ApEn', 'SampEn', 'alpha1', 'alpha2']
+
+def poincare(rr):
+    """Given RR intervals (ms), returns (SD1, SD2) (ms): the standard deviations of the
+    Poincare plot (RR[i+1] vs RR[i]) perpendicular to and along the line of identity"""
+    rr = np.asarray(rr, dtype=np.float64)
+    if len(rr) < 3:
+        return (np.nan, np.nan)
+    sd1_sq = np.var(np.diff(rr), ddof=1) / 2.0
+    sd2_sq = 2.0 * np.var(rr, ddof=1) - sd1_sq
+    return (np.sqrt(sd1_sq), np.sqrt(max(sd2_sq, 0.0)))
+
+def _templates(x, m):
+    """Returns the (len(x) - m + 1) x m matrix whose rows are the length-m runs of x.
+    It's a strided view, so nothing is copied."""
+    return np.lib.stride_tricks.as_strided(x, shape=(len(x) - m + 1, m), strides=(x.strides[0], x.strides[0]))
+
+def _tolerance(rr, tolerance):
+    return tolerance * np.std(rr, ddof=1)
+
+def sample_entropy(rr, m=ENTROPY_DIMENSION, tolerance=ENTROPY_TOLERANCE):
+    """Returns the sample entropy of the RR intervals rr: -ln(A/B), where B is the number of
+    pairs of distinct length-m templates within r (Chebyshev distance) of each other and A is
+    the number of those pairs that are still within r when extended to length m+1.
+    r is tolerance times the standard deviation of rr. Pairs are counted with a k-d tree
+    rather than by comparing every template with every other one.
+    Returns NaN if it is undefined (too few beats, or no matching pairs)."""
+    rr = np.asarray(rr, dtype=np.float64)
+    n = len(rr)
+    if n < m + 2:
+        return np.nan
+    r = _tolerance(rr, tolerance)
+    counts = []
+    for dim in [m, m + 1]:
+        # use the same n - m templates for both lengths, so that A and B are comparable
+        templates = _templates(rr, dim)[:n - m]
+        tree = cKDTree(templates)
+        # count_neighbors counts ordered pairs, including each template with itself
+        counts.append((tree.count_neighbors(tree, r, p=np.inf) - len(templates)) / 2)
+    (b, a) = counts
+    if a == 0 or b == 0:
+        return np.nan
+    return -np.log(a / b)
+
+def approximate_entropy(rr, m=ENTROPY_DIMENSION, tolerance=ENTROPY_TOLERANCE):
+    """Returns the approximate entropy of the RR intervals rr: phi(m) - phi(m+1), where phi(k)
+    is the mean log of the fraction of length-k templates within r (Chebyshev distance)
+    of each template, itself included. r is tolerance times the standard deviation of rr.
+    Neighbours are counted with a k-d tree. Returns NaN if there are too few beats."""
+    rr = np.asarray(rr, dtype=np.float64)
+    n = len(rr)
+    if n < m + 2:
+        return np.nan
+    r = _tolerance(rr, tolerance)
+    phi = []
+    for dim in [m, m + 1]:
+        templates = _templates(rr, dim)
+        tree = cKDTree(templates)
+        num_neighbours = tree.query_ball_point(templates, r, p=np.inf, return_length=True)
+        phi.append(np.mean(np.log(num_neighbours / len(templates))))
+    return phi[0] - phi[1]
+
+def dfa_fluctuations(rr, box_sizes):
+    """Returns the detrended fluctuation F(n) of the RR intervals rr for each box size n in box_sizes.
+    The integrated, mean-removed series is split into non-overlapping boxes of n beats, a line
+    is fitted to each box and F(n) is the root mean square of the residuals. The fits for all of the
+    boxes of a given size are done at once, in closed form. Box sizes with no complete box get NaN."""
+    rr = np.asarray(rr, dtype=np.float64)
+    y = np.cumsum(rr - rr.mean())
+    fluctuations = np.full(len(box_sizes), np.nan)
+    for (i, n) in enumerate(box_sizes):
+        num_boxes = len(y) // n
+        if num_boxes == 0 or n < 2:
+            continue
+        boxes = y[:num_boxes * n].reshape(num_boxes, n)
+        t = np.arange(n) - (n - 1) / 2.0
+        slopes = (boxes @ t) / (t @ t)
+        residuals = boxes - boxes.mean(axis=1, keepdims=True) - np.outer(slopes, t)
+        fluctuations[i] = np.sqrt(np.mean(residuals ** 2))
+    return fluctuations
+
+def dfa(rr, alpha1_range=DFA_ALPHA1_RANGE, alpha2_range=DFA_ALPHA2_RANGE):
+    """Returns (alpha1, alpha2): the slopes of log F(n) vs log n (see dfa_fluctuations)
+    over the short-term and long-term ranges of box sizes (in beats, inclusive).
+    A slope is NaN if fewer than two of its box sizes fit in rr."""
+    lo = min(alpha1_range[0], alpha2_range[0])
+    hi = max(alpha1_range[1], alpha2_range[1])
+    box_sizes = np.arange(lo, hi + 1)
+    fluctuations = dfa_fluctuations(rr, box_sizes)
+    alphas = []
+    for (first, last) in [alpha1_range, alpha2_range]:
+        in_range = (box_sizes >= first) & (box_sizes <= last) & (fluctuations > 0)
+        if np.count_nonzero(in_range) < 2:
+            alphas.append(np.nan)
+            continue
+        alphas.append(np.polyfit(np.log10(box_sizes[in_range]), np.log10(fluctuations[in_range]), 1)[0])
+    return tuple(alphas)
+
+def nonlinear(rr, sample_start=None, sample_length=None):
+    """Returns a dict of the nonlinear metrics (METRIC_NAMES) for a single series of RR intervals (ms).
+    SD1 and SD2 are in ms; the others are unitless.
+    See hrv.sample_window for sample_start and sample_length."""
+    rr = hrv.sample_window(rr, sample_start, sample_length)
+    metrics = {}
+    (metrics['SD1'], metrics['SD2']) = poincare(rr)
+    metrics['ApEn'] = approximate_entropy(rr)
+    metrics['SampEn'] = sample_entropy(rr)
+    (metrics['alpha1'], metrics['alpha2']) = dfa(rr)
+    return metrics
+
+def nonlinear_batch(rr_series, sample_start=None, sample_length=None):
+    """Returns a dict of metric name -> array with one value per series in rr_series,
+    where rr_series is a sequence of RR interval series (ms), which may differ in length.
+    See nonlinear for units and hrv.sample_window for sample_start and sample_length."""
+    stats = {name: np.full(len(rr_series), np.nan) for name in METRIC_NAMES}
+    for (i, rr) in enumerate(rr_series):
+        for (name, value) in nonlinear(rr, sample_start, sample_length).items():
+            stats[name][i] = value
+    return stats
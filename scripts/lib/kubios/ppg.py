@@ -0,0 +1,143 @@
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import butter, sosfiltfilt
+
+# Pass band (Hz) of the filter applied to the pulse signal before looking for beats
+BANDPASS = (0.5, 8.0)
+BANDPASS_ORDER = 2
+
+# Adaptive threshold parameters (Elgendi et al. 2013): widths (s) of the moving averages
+# that follow the systolic peak and the whole beat, and the offset added to the latter,
+# as a fraction of the mean of the squared signal
+PEAK_WINDOW = 0.111
+BEAT_WINDOW = 0.667
+THRESHOLD_OFFSET = 0.02
+
+# Two beats can't be closer together than this (s); the smaller of any such pair is dropped
+REFRACTORY_PERIOD = 0.3
+
+# The signal is processed this many seconds at a time, each chunk padded on both sides
+# so that the filter and moving averages don't see the chunk edges
+CHUNK_SECONDS = 60
+CHUNK_PADDING = 5
+
+def _block_peaks(y, blocks):
+    """Returns the index of the maximum of y within each of the (start, end) blocks"""
+    (starts, ends) = blocks
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    block_id = np.repeat(np.arange(len(starts)), lengths)
+    idx = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    values = y[idx]
+    is_max = values == np.maximum.reduceat(values, offsets)[block_id]
+    (_, first) = np.unique(block_id[is_max], return_index=True)
+    return idx[is_max][first]
+
+def _chunk_peaks(x, fs, sos):
+    """Returns the indices of the candidate beats in x (a padded chunk of the pulse signal)"""
+    y = sosfiltfilt(sos, x - x.mean())
+    z = np.square(np.maximum(y, 0.0))
+    peak_width = max(1, int(round(PEAK_WINDOW * fs)))
+    ma_peak = uniform_filter1d(z, peak_width)
+    ma_beat = uniform_filter1d(z, max(1, int(round(BEAT_WINDOW * fs))))
+    above = ma_peak > ma_beat + THRESHOLD_OFFSET * z.mean()
+
+    # blocks of interest: runs of samples above the threshold at least as wide as a systolic peak
+    edges = np.diff(above.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    wide_enough = (ends - starts) >= peak_width
+    if not wide_enough.any():
+        return (np.zeros(0, dtype=np.int64), y)
+    return (_block_peaks(y, (starts[wide_enough], ends[wide_enough])), y)
+
+def enforce_refractory_period(peaks, heights, min_distance):
+    """Given beat positions (increasing) and their heights, drops the smaller beat of any pair
+    closer than min_distance until none are left. Returns the indices of the beats kept."""
+    kept = []
+    for i in range(len(peaks)):
+        if kept and peaks[i] - peaks[kept[-1]] < min_distance:
+            if heights[i] > heights[kept[-1]]:
+                kept[-1] = i
+            continue
+        kept.append(i)
+    return np.array(kept, dtype=np.int64)
+
+class BeatDetector:
+    """Detects beats (see detect_beats) in a pulse signal that arrives in chunks of any size.
+    The signal is cut into the same padded chunk_seconds chunks detect_beats uses, and only the
+    samples the next of those still needs are kept, so memory use doesn't depend on the length
+    of the signal. Call process with each chunk in turn and finish after the last one."""
+
+    def __init__(self, fs, chunk_seconds=CHUNK_SECONDS):
+        self.fs = fs
+        self.sos = butter(BANDPASS_ORDER, BANDPASS, btype='bandpass', fs=fs, output='sos')
+        self.chunk = int(chunk_seconds * fs)
+        self.pad = int(CHUNK_PADDING * fs)
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0 # index (in the whole signal) of the first sample in buffer
+        self.core_start = 0 # index of the first sample of the next chunk to look for beats in
+        self.peaks = []
+        self.heights = []
+
+    def _process_core(self):
+        buffer_end = self.buffer_start + len(self.buffer)
+        start = self.core_start
+        end = min(start + self.chunk, buffer_end)
+        lo = max(0, start - self.pad)
+        hi = min(buffer_end, end + self.pad)
+        x = self.buffer[lo - self.buffer_start:hi - self.buffer_start]
+        self.core_start = end
+        # sosfiltfilt needs a few times the filter order worth of samples
+        if len(x) <= 3 * (2 * BANDPASS_ORDER + 1) * 2:
+            return
+        (chunk_peaks, y) = _chunk_peaks(x, self.fs, self.sos)
+        # only keep the peaks in this chunk's own (unpadded) part
+        in_core = (chunk_peaks >= start - lo) & (chunk_peaks < end - lo)
+        self.peaks.append(chunk_peaks[in_core] + lo)
+        self.heights.append(y[chunk_peaks[in_core]])
+
+    def process(self, x):
+        """Adds the next chunk of the signal, looking for beats in any whole chunks it completes"""
+        self.buffer = np.concatenate((self.buffer, np.asarray(x, dtype=np.float64)))
+        while self.buffer_start + len(self.buffer) >= self.core_start + self.chunk + self.pad:
+            self._process_core()
+            # drop the samples no later chunk (or its padding) needs
+            keep_from = max(self.buffer_start, self.core_start - self.pad)
+            self.buffer = self.buffer[keep_from - self.buffer_start:]
+            self.buffer_start = keep_from
+
+    def finish(self):
+        """Looks for beats in the rest of the signal and returns the sample indices of all of them"""
+        while self.core_start < self.buffer_start + len(self.buffer):
+            self._process_core()
+        self.buffer = np.zeros(0)
+        if not self.peaks:
+            return np.zeros(0, dtype=np.int64)
+        peaks = np.concatenate(self.peaks)
+        heights = np.concatenate(self.heights)
+        return peaks[enforce_refractory_period(peaks, heights, REFRACTORY_PERIOD * self.fs)]
+
+def detect_beats(signal, fs, chunk_seconds=CHUNK_SECONDS):
+    """Returns the sample indices of the beats (systolic peaks) in a pulse (PPG) signal sampled
+    at fs Hz. The signal is band-pass filtered, an adaptive threshold (a moving average over a beat
+    plus an offset) picks out blocks around each peak, the highest point of each block is taken
+    as the beat and beats closer than REFRACTORY_PERIOD are thinned out. Each step works on a whole
+    chunk of chunk_seconds at a time, so signal may be anything that can be sliced, e.g. a memmap."""
+    detector = BeatDetector(fs, chunk_seconds)
+    step = detector.chunk or 1
+    for start in range(0, len(signal), step):
+        detector.process(signal[start:start + step])
+    return detector.finish()
+
+def rr_intervals(signal, fs, chunk_seconds=CHUNK_SECONDS):
+    """Returns the RR intervals (ms) between the beats detect_beats finds in signal"""
+    return np.diff(detect_beats(signal, fs, chunk_seconds)) * 1000.0 / fs
+
+def stream_rr_intervals(chunks, fs, chunk_seconds=CHUNK_SECONDS):
+    """Returns the RR intervals (ms) between the beats in a pulse signal given as an iterable
+    of chunks (e.g. the generator pulse.iter_pulse_txt_data returns), using a BeatDetector"""
+    detector = BeatDetector(fs, chunk_seconds)
+    for x in chunks:
+        detector.process(x)
+    return np.diff(detector.finish()) * 1000.0 / fs
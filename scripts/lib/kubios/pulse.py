@@ -0,0 +1,142 @@
+import mmap
+import numpy as np
+import os
+import re
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+# Column separators, by the kubios.*_SEPARATOR constant used in the kubios ASCII import dialog
+SEPARATORS = {0: None, 1: b',', 2: b';'}
+
+# Factors that convert data in each of the kubios.*_UNIT units to volts
+UNIT_SCALES = {0: 1e-6, 1: 1e-3, 2: 1.0}
+VOLTS = 2 # kubios.V_UNIT
+
+# Number of bytes of the file parsed at a time (rounded down to a whole number of lines)
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# Matches the end of each blank line (or one holding only whitespace) in the data
+BLANK_LINE = re.compile(rb'\n[ \t\r]*(?=\n)')
+
+# Order of the anti-aliasing filter applied before decimating, and its cutoff
+# as a fraction of the new Nyquist frequency
+ANTI_ALIAS_ORDER = 8
+ANTI_ALIAS_CUTOFF = 0.8
+
+def _data_start(mapped, num_header_lines):
+    """Returns the offset of the first byte after the header lines"""
+    offset = 0
+    for _ in range(num_header_lines):
+        newline = mapped.find(b'\n', offset)
+        if newline == -1:
+            return len(mapped)
+        offset = newline + 1
+    return offset
+
+def _parse_lines(text, col_separator, num_cols):
+    """Parses whole lines of numbers into a (lines, num_cols) array in one vectorized call. Blank lines are skipped."""
+    separator = SEPARATORS[col_separator]
+    if separator is not None:
+        text = text.replace(separator, b' ')
+    text = text.strip()
+    if not text:
+        return np.zeros((0, num_cols))
+    values = np.fromstring(text, sep=' ')
+    num_lines = text.count(b'\n') + 1 - len(BLANK_LINE.findall(text))
+    if len(values) != num_lines * num_cols:
+        raise Exception('Expected {} numeric columns on each of {} lines but found {} values; check the header line count and separator.'.format(num_cols, num_lines, len(values)))
+    return values.reshape(num_lines, num_cols)
+
+def iter_pulse_txt(txt_file_path, num_header_lines=0, col_separator=0, time_index_col=0, data_col=5, data_unit=VOLTS, chunk_bytes=CHUNK_BYTES):
+    """Reads a pulse text file described the same way kubios.open_txt_file describes it (columns
+    are 1-based and a time_index_col of 0 means there is none). The file is memory-mapped and
+    parsed chunk_bytes at a time, so memory use doesn't depend on the size of the file.
+    This is a generator, yielding (time index or None, data in volts) arrays for each chunk."""
+    with open(txt_file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = _data_start(mapped, num_header_lines)
+            first_line_end = mapped.find(b'\n', offset)
+            first_line = mapped[offset:first_line_end if first_line_end != -1 else len(mapped)]
+            separator = SEPARATORS[col_separator]
+            num_cols = len((first_line.replace(separator, b' ') if separator else first_line).split())
+            if data_col > num_cols or time_index_col > num_cols:
+                raise Exception('{} only has {} columns.'.format(txt_file_path, num_cols))
+
+            scale = UNIT_SCALES[data_unit]
+            while offset < len(mapped):
+                end = min(offset + chunk_bytes, len(mapped))
+                if end < len(mapped):
+                    # stop at the end of the last whole line in the chunk
+                    line_end = mapped.rfind(b'\n', offset, end)
+                    if line_end == -1:
+                        # a single line longer than the chunk; read to its end
+                        line_end = mapped.find(b'\n', end)
+                    end = len(mapped) if line_end == -1 else line_end + 1
+                rows = _parse_lines(mapped[offset:end], col_separator, num_cols)
+                offset = end
+                if len(rows) == 0:
+                    continue
+                times = rows[:, time_index_col - 1] if time_index_col > 0 else None
+                yield (times, rows[:, data_col - 1] * scale)
+
+class Decimator:
+    """Decimates a signal that arrives in chunks by an integer factor, low-pass filtering it first
+    so that it doesn't alias. The filter state and the position of the next sample to keep are
+    carried from one chunk to the next, so the output is the same however the signal is chunked."""
+
+    def __init__(self, in_rate, out_rate):
+        if in_rate % out_rate != 0:
+            raise Exception('Can only downsample by an integer factor, but {} is not a multiple of {}.'.format(in_rate, out_rate))
+        self.factor = int(in_rate // out_rate)
+        self.sos = butter(ANTI_ALIAS_ORDER, ANTI_ALIAS_CUTOFF * out_rate / 2.0, fs=in_rate, output='sos')
+        self.zi = None
+        self.phase = 0
+
+    def process(self, x, times=None):
+        """Returns the decimated (times, x) for the next chunk of the signal (times may be None)"""
+        x = np.asarray(x, dtype=np.float64)
+        if self.factor == 1 or len(x) == 0:
+            return (times, x)
+        if self.zi is None:
+            self.zi = sosfilt_zi(self.sos) * x[0]
+        (filtered, self.zi) = sosfilt(self.sos, x, zi=self.zi)
+        keep = slice(self.phase, None, self.factor)
+        self.phase = (self.phase - len(x)) % self.factor
+        return (None if times is None else times[keep], filtered[keep])
+
+def iter_pulse_txt_data(txt_file_path, num_header_lines=0, col_separator=0, time_index_col=0, data_col=5, data_unit=VOLTS, sample_rate=10000, out_rate=None):
+    """Yields the pulse data (volts) in a pulse text file (see iter_pulse_txt) a chunk at a time,
+    decimated to out_rate Hz (see Decimator) if it's given"""
+    decimator = Decimator(sample_rate, out_rate or sample_rate)
+    for (_, data) in iter_pulse_txt(txt_file_path, num_header_lines, col_separator, time_index_col, data_col, data_unit):
+        yield decimator.process(data)[1]
+
+def read_pulse_txt(txt_file_path, num_header_lines=0, col_separator=0, time_index_col=0, data_col=5, data_unit=VOLTS, sample_rate=10000, out_rate=None):
+    """Returns the pulse data (volts) in a pulse text file (see iter_pulse_txt_data). Only the (decimated)
+    result is held in memory; to process a long recording without holding all of it, use iter_pulse_txt_data."""
+    chunks = list(iter_pulse_txt_data(txt_file_path, num_header_lines, col_separator, time_index_col, data_col, data_unit, sample_rate, out_rate))
+    if not chunks:
+        return np.zeros(0)
+    return np.concatenate(chunks)
+
+def downsample_pulse_txt(txt_file_path, out_file_path, num_header_lines=0, col_separator=0, time_index_col=0, data_col=5, data_unit=VOLTS, sample_rate=10000, out_rate=1000):
+    """Writes a decimated copy of a pulse text file (see iter_pulse_txt and Decimator) to out_file_path,
+    chunk by chunk. The copy has no header, is tab-separated and has the time index (if there is one)
+    in its first column and the data, in volts, after it. Returns a dict describing the copy with the
+    arguments kubios.open_txt_file takes: num_header_lines, col_separator, time_index_col, data_col,
+    data_unit and ppg_sample_rate."""
+    decimator = Decimator(sample_rate, out_rate)
+    with open(out_file_path, 'w') as out:
+        for (times, data) in iter_pulse_txt(txt_file_path, num_header_lines, col_separator, time_index_col, data_col, data_unit):
+            (times, data) = decimator.process(data, times)
+            columns = [data] if times is None else [times, data]
+            np.savetxt(out, np.column_stack(columns), fmt='%.9g', delimiter='\t')
+    return {
+        'num_header_lines': 0,
+        'col_separator': 0,
+        'time_index_col': 1 if time_index_col > 0 else 0,
+        'data_col': 2 if time_index_col > 0 else 1,
+        'data_unit': VOLTS,
+        'ppg_sample_rate': out_rate
+    }
@@ -0,0 +1,56 @@
+import numpy as np
+
+# RR intervals (ms) outside of this range (200 to 30 bpm) can't be real heartbeats
+MIN_PLAUSIBLE_RR = 300
+MAX_PLAUSIBLE_RR = 2000
+
+# RR intervals (ms) at least this long are treated as gaps in the signal
+# (e.g. the sensor lost contact) rather than as heartbeats
+DROPOUT_RR = 3000
+
+# Default thresholds for triage
+MIN_DURATION = 60 # seconds
+MAX_PCT_IMPLAUSIBLE = 5.0
+MAX_PCT_DROPOUT = 10.0
+
+def quality_batch(rr_series):
+    """Returns a dict of metric name -> array with one value per RR interval series (ms) in rr_series:
+    n_beats, duration (s), pct_implausible (percentage of beats outside of
+    [MIN_PLAUSIBLE_RR, MAX_PLAUSIBLE_RR]) and pct_dropout (percentage of the session's time
+    spent in intervals of DROPOUT_RR or longer). The series are concatenated and reduced
+    segment-by-segment, so there is no per-beat Python work."""
+    lengths = np.array([len(rr) for rr in rr_series], dtype=np.int64)
+    metrics = {
+        'n_beats': lengths,
+        'duration': np.zeros(len(lengths)),
+        'pct_implausible': np.zeros(len(lengths)),
+        'pct_dropout': np.zeros(len(lengths))
+    }
+    non_empty = lengths > 0
+    if not non_empty.any():
+        return metrics
+
+    rr = np.concatenate([np.asarray(s, dtype=np.float64) for s in rr_series])
+    starts = np.concatenate(([0], np.cumsum(lengths[non_empty])[:-1]))
+    total_ms = np.add.reduceat(rr, starts)
+    implausible = np.add.reduceat(((rr < MIN_PLAUSIBLE_RR) | (rr > MAX_PLAUSIBLE_RR)).astype(np.int64), starts)
+    dropout_ms = np.add.reduceat(np.where(rr >= DROPOUT_RR, rr, 0.0), starts)
+
+    metrics['duration'][non_empty] = total_ms / 1000.0
+    metrics['pct_implausible'][non_empty] = 100.0 * implausible / lengths[non_empty]
+    metrics['pct_dropout'][non_empty] = 100.0 * np.divide(dropout_ms, total_ms, out=np.zeros_like(total_ms), where=total_ms > 0)
+    return metrics
+
+def triage(rr_series, min_duration=MIN_DURATION, max_pct_implausible=MAX_PCT_IMPLAUSIBLE, max_pct_dropout=MAX_PCT_DROPOUT):
+    """Checks each of the RR interval series (ms) in rr_series against the given thresholds.
+    Returns a list with one entry per series: an empty list if the series passed, and a list
+    of human-readable reasons it failed if not."""
+    metrics = quality_batch(rr_series)
+    problems = [[] for _ in range(len(metrics['n_beats']))]
+    for i in np.flatnonzero(metrics['duration'] < min_duration):
+        problems[i].append('only {:.1f}s long (minimum is {}s)'.format(metrics['duration'][i], min_duration))
+    for i in np.flatnonzero(metrics['pct_implausible'] > max_pct_implausible):
+        problems[i].append('{:.1f}% of RR intervals are implausible (maximum is {}%)'.format(metrics['pct_implausible'][i], max_pct_implausible))
+    for i in np.flatnonzero(metrics['pct_dropout'] > max_pct_dropout):
+        problems[i].append('signal dropped out for {:.1f}% of the session (maximum is {}%)'.format(metrics['pct_dropout'][i], max_pct_dropout))
+    return problems
@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import os
+
+# Suffixes of output files generated by kubios
+OUTPUT_SUFFIXES = ['.pdf', '.txt', '.mat']
+
+# Paths (within the .mat file) of the datasets the settings are read from
+AR_ORDER_PATH = 'Res/HRV/Param/AR_order'
+ARTIFACT_CORRECTION_PATH = 'Res/HRV/Param/Artifact_correction'
+SEGMENTS_PATH = 'Res/HRV/Param/Segments'
+EKG_RATE_PATH = 'Res/CNT/rate/EKG'
+
+# Paths of the summary values (see KubiosResults.summary), by name
+SUMMARY_PATHS = {
+    'mean_HR': 'Res/HRV/Statistics/mean_HR',
+    'min_HR': 'Res/HRV/Statistics/min_HR',
+    'max_HR': 'Res/HRV/Statistics/max_HR',
+    'RMSSD': 'Res/HRV/Statistics/RMSSD',
+    'LF_power': 'Res/HRV/Frequency/AR/LF_power',
+    'LF_peak': 'Res/HRV/Frequency/AR/LF_peak'
+}
+
+# Default number of threads used to check the results in an output directory
+VERIFY_WORKERS = 8
+
+class KubiosResults:
+    """Reader for the matlab version of the kubios output. The file is opened once
+    and datasets are only read when asked for (and then cached), using their full
+    paths (e.g. 'Res/HRV/Statistics/RMSSD') rather than chains of group lookups.
+    Use it as a context manager, or call open() and close() yourself."""
+
+    def __init__(self, matlab_results):
+        self.path = matlab_results
+        self.file = None
+        self._cache = {}
+
+    def open(self):
+        self.file = h5py.File(self.path, 'r')
+        return self
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def has(self, dataset_path):
+        return dataset_path in self.file
+
+    def get(self, dataset_path):
+        """Returns the contents of the dataset at dataset_path as a numpy array"""
+        if dataset_path not in self._cache:
+            self._cache[dataset_path] = self.file[dataset_path][()]
+        return self._cache[dataset_path]
+
+    def scalar(self, dataset_path):
+        """Returns the single value stored in the (1x1) dataset at dataset_path"""
+        return self.get(dataset_path)[0][0]
+
+    def row(self, dataset_path):
+        """Returns the first row of the dataset at dataset_path (kubios stores vectors as 1xN matrices)"""
+        return self.get(dataset_path)[0]
+
+    def string(self, dataset_path):
+        """Returns the string stored (as character codes) in the dataset at dataset_path"""
+        return ''.join(chr(c) for c in np.ravel(self.get(dataset_path)))
+
+    def settings(self):
+        """Returns some of the settings kubios was run with (see kubios.get_settings)"""
+        kubios_settings = {}
+        kubios_settings['ar_model'] = self.scalar(AR_ORDER_PATH)
+        kubios_settings['artifact_correction'] = self.string(ARTIFACT_CORRECTION_PATH)
+        segments = self.get(SEGMENTS_PATH)
+        kubios_settings['sample_start'] = round(segments[0][0])
+        kubios_settings['sample_length'] = round(segments[1][0])
+        # not all files will have EKG sample rate
+        if self.has(EKG_RATE_PATH):
+            kubios_settings['ppg_sample_rate'] = self.scalar(EKG_RATE_PATH)
+        return kubios_settings
+
+    def summary(self):
+        """Returns a dict with the settings (see settings) and whichever of the SUMMARY_PATHS
+        values the file has, as plain python numbers and strings (so it can be written as json)"""
+        summary = {k: (v if isinstance(v, str) else v.item() if hasattr(v, 'item') else v) for (k, v) in self.settings().items()}
+        for (name, dataset_path) in SUMMARY_PATHS.items():
+            if self.has(dataset_path):
+                summary[name] = self.scalar(dataset_path).item()
+        return summary
+
+def unexpected_settings(settings, expected):
+    """Given the settings kubios was run with and a dict of the settings we expected,
+    returns an empty list if everything matches and a list of
+    (setting_name, expected_value, actual_value) tuples if not."""
+    return [(k, expected[k], settings.get(k)) for k in expected.keys() if expected[k] != settings.get(k)]
+
+def _verify_result(mat_file, expected):
+    try:
+        with KubiosResults(mat_file) as kubios_results:
+            return (unexpected_settings(kubios_results.settings(), expected), None)
+    except (OSError, KeyError) as err:
+        return ([], str(err))
+
+def verify_output_dir(output_dir, expected, max_workers=VERIFY_WORKERS):
+    """Checks every kubios result in output_dir. The directory is listed once (with os.scandir)
+    to find each result's output files, and each result's settings are compared to the
+    expected dict (see unexpected_settings) by a pool of max_workers threads.
+    Returns a report: a list, sorted by result path prefix, of
+    (prefix, missing output files, unexpected settings, error reading the .mat file or None) tuples."""
+    suffixes_by_prefix = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            (prefix, suffix) = os.path.splitext(entry.path)
+            if suffix in OUTPUT_SUFFIXES and entry.is_file():
+                suffixes_by_prefix.setdefault(prefix, set()).add(suffix)
+
+    # a stray .txt file on its own isn't necessarily kubios output, so only
+    # count something as a result if it has a .mat or .pdf file
+    prefixes = sorted(p for (p, s) in suffixes_by_prefix.items() if '.mat' in s or '.pdf' in s)
+    mat_prefixes = [p for p in prefixes if '.mat' in suffixes_by_prefix[p]]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checks = dict(zip(mat_prefixes, executor.map(lambda p: _verify_result(p + '.mat', expected), mat_prefixes)))
+
+    report = []
+    for prefix in prefixes:
+        missing = [prefix + s for s in OUTPUT_SUFFIXES if s not in suffixes_by_prefix[prefix]]
+        (unexpected, err) = checks.get(prefix, ([], None))
+        report.append((prefix, missing, unexpected, err))
+    return report
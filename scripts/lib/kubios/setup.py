@@ -4,9 +4,12 @@ setup(
     'colorama',
     'datetime',
     'h5py',
-    'pywinauto'
+    'numpy>=1.20',
+    'pywinauto',
+    'scipy'
     ],
     name="kubios",
     version="0.2",
     packages=find_packages(),
+    py_modules=['kubios', 'acq', 'artifacts', 'coherence', 'detrending', 'hrv', 'live', 'nonlinear', 'ppg', 'pulse', 'quality', 'results', 'spectrum', 'windowed'],
 )
\ No newline at end of file
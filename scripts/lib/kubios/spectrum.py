@@ -0,0 +1,230 @@
+import detrending
+from functools import lru_cache
+import hrv
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+from scipy.interpolate import CubicSpline
+
+# Rate (Hz) the RR tachogram is resampled at before spectral analysis (the kubios default)
+RESAMPLE_RATE = 4.0
+
+# AR model order (confirm_expected_settings insists kubios uses this)
+AR_ORDER = 16
+
+# Number of points in the frequency grid the AR spectrum is evaluated on, from 0 Hz to RESAMPLE_RATE / 2
+AR_FREQ_POINTS = 1025
+
+# Welch periodogram settings (the kubios defaults): window width (s), fractional window overlap
+# and the number of points per Hz in the frequency grid
+WELCH_WINDOW_WIDTH = 300
+WELCH_OVERLAP = 0.5
+WELCH_POINTS_PER_HZ = 300
+
+# A spectrum has multiple peaks if, on either side of its peak, it drops to this fraction
+# of the peak value or lower and later rises back to it or higher
+MULTI_PEAK_THRESHOLD = 0.25
+
+# Frequency bands (Hz), as (lower bound inclusive, upper bound exclusive)
+VLF_BAND = (0.0, 0.04)
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.4)
+
+def resample_tachogram(rr, sample_start=None, sample_length=None, fs=RESAMPLE_RATE):
+    """Given RR intervals (ms), returns the tachogram (RR interval as a function of beat time)
+    for the selected sample, resampled at fs Hz using cubic spline interpolation.
+    See hrv.sample_window for sample_start and sample_length."""
+    rr = hrv.sample_window(rr, sample_start, sample_length)
+    if len(rr) < 4:
+        raise ValueError('At least four beats are required to resample the RR tachogram.')
+    t = hrv.beat_times(rr)
+    t_even = np.arange(t[0], t[-1], 1.0 / fs)
+    return CubicSpline(t, rr)(t_even)
+
+def burg(x, order=AR_ORDER):
+    """Fits an AR model of the given order to each row of x (a 2d array of equal-length series)
+    using Burg's method. Returns (a, noise_variance), where a has shape (rows, order + 1) and
+    holds the coefficients of 1 + a[1]z^-1 + ... + a[order]z^-order, and noise_variance has
+    one value per row. All of the rows are fit at once; the only Python loop is over the order."""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    (rows, n) = x.shape
+    if n <= order:
+        raise ValueError('Series of length {} are too short for an AR({}) model.'.format(n, order))
+    a = np.zeros((rows, order + 1))
+    a[:, 0] = 1.0
+    noise_variance = np.mean(x ** 2, axis=1)
+    f = x[:, 1:].copy()
+    b = x[:, :-1].copy()
+    for m in range(order):
+        num = -2.0 * np.sum(f * b, axis=1)
+        den = np.sum(f ** 2, axis=1) + np.sum(b ** 2, axis=1)
+        k = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+        a[:, 1:m + 2] = a[:, 1:m + 2] + k[:, None] * a[:, m::-1]
+        noise_variance = noise_variance * (1.0 - k ** 2)
+        (f, b) = (f[:, 1:] + k[:, None] * b[:, 1:], b[:, :-1] + k[:, None] * f[:, :-1])
+    return (a, noise_variance)
+
+def ar_psd(a, noise_variance, freqs, fs=RESAMPLE_RATE):
+    """Returns the one-sided power spectral density (units^2/Hz) of the AR models
+    described by a and noise_variance (see burg) at each of the given frequencies,
+    as an array of shape (models, frequencies)."""
+    order = a.shape[1] - 1
+    z = np.exp(-2j * np.pi * np.outer(np.arange(order + 1), freqs) / fs)
+    response = a @ z
+    return 2.0 * noise_variance[:, None] / (fs * np.abs(response) ** 2)
+
+def band_power(freqs, psd, band):
+    """Returns the power in band (lower, upper) of each row of psd, integrated with the trapezoid rule"""
+    in_band = (freqs >= band[0]) & (freqs < band[1])
+    f = freqs[in_band]
+    p = psd[..., in_band]
+    return np.sum((p[..., 1:] + p[..., :-1]) * np.diff(f), axis=-1) / 2.0
+
+def band_peak(freqs, psd, band):
+    """Returns (peak frequencies, peak psd values): the frequency in band (lower, upper) at which
+    each row of psd is highest, and the psd at that frequency"""
+    in_band = np.flatnonzero((freqs >= band[0]) & (freqs < band[1]))
+    idx = in_band[np.argmax(psd[..., in_band], axis=-1)]
+    return (freqs[idx], np.take_along_axis(np.atleast_2d(psd), np.atleast_1d(idx)[:, None], axis=-1)[:, 0])
+
+def ar_spectrum_batch(rr_series, sample_start=None, sample_length=None, order=AR_ORDER, fs=RESAMPLE_RATE, n_freqs=AR_FREQ_POINTS, detrend=detrending.smoothness_priors):
+    """Computes the AR spectrum of each of the RR interval series (ms) in rr_series.
+    Each series is resampled and detrended (by default with smoothness priors, as kubios does), series of equal resampled length are fit together
+    (see burg), and the spectra are evaluated on a common frequency grid.
+    Returns a dict named after the fields of Res.HRV.Frequency.AR in the kubios output:
+    F (Hz), PSD (ms^2/Hz, one row per series), LF_power (ms^2) and LF_peak (Hz), plus
+    LF_peak_power, the PSD at LF_peak (which calibration writes to the sheet as 'LF peak Y').
+    See hrv.sample_window for sample_start and sample_length."""
+    freqs = np.linspace(0.0, fs / 2.0, n_freqs)
+    tachograms = [resample_tachogram(rr, sample_start, sample_length, fs) for rr in rr_series]
+    psd = np.empty((len(tachograms), n_freqs))
+    lengths = np.array([len(x) for x in tachograms])
+    for n in np.unique(lengths):
+        rows = np.flatnonzero(lengths == n)
+        x = detrend(np.stack([tachograms[i] for i in rows]))
+        (a, noise_variance) = burg(x, order)
+        psd[rows] = ar_psd(a, noise_variance, freqs, fs)
+
+    (lf_peak, lf_peak_power) = band_peak(freqs, psd, LF_BAND)
+    return {
+        'F': freqs,
+        'PSD': psd,
+        'LF_power': band_power(freqs, psd, LF_BAND),
+        'LF_peak': lf_peak,
+        'LF_peak_power': lf_peak_power
+    }
+
+def ar_spectrum(rr, sample_start=None, sample_length=None, order=AR_ORDER, fs=RESAMPLE_RATE, n_freqs=AR_FREQ_POINTS, detrend=detrending.smoothness_priors):
+    """Single-series version of ar_spectrum_batch"""
+    result = ar_spectrum_batch([rr], sample_start, sample_length, order, fs, n_freqs, detrend)
+    return {k: (v if k == 'F' else v[0]) for (k, v) in result.items()}
+
+@lru_cache(maxsize=32)
+def _welch_window(seg_len):
+    """Returns (window, scale) for Welch segments of length seg_len. Cached, since every
+    session analysed with the same sample length uses the same segment length."""
+    window = np.hanning(seg_len + 2)[1:-1] # a hanning window without its zero end points
+    window.setflags(write=False)
+    return (window, 1.0 / np.sum(window ** 2))
+
+def welch_psd(x, fs=RESAMPLE_RATE, window_width=WELCH_WINDOW_WIDTH, overlap=WELCH_OVERLAP, points_per_hz=WELCH_POINTS_PER_HZ):
+    """Returns (freqs, psd): Welch's periodogram of each row of x (a 2d array of equal-length series
+    sampled at fs Hz). Segments are window_width seconds long (or the whole series, if it's shorter)
+    and overlap by the given fraction; each is de-meaned and hanning-windowed. The FFTs of every
+    segment of every row are taken in a single batched call, zero-padded so that there are
+    points_per_hz points per Hz. psd has one row per row of x and is one-sided (units^2/Hz)."""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    n = x.shape[1]
+    seg_len = min(n, int(round(window_width * fs)))
+    step = max(1, int(round(seg_len * (1.0 - overlap))))
+    nfft = max(seg_len, int(round(points_per_hz * fs)))
+
+    segments = sliding_window_view(x, seg_len, axis=1)[:, ::step, :]
+    segments = segments - segments.mean(axis=2, keepdims=True)
+    (window, scale) = _welch_window(seg_len)
+    # scipy.fft keeps its own cache of FFT plans, so repeated calls with the same nfft reuse them
+    spectra = fft.rfft(segments * window, n=nfft, axis=2, workers=-1)
+    psd = (np.abs(spectra) ** 2).mean(axis=1) * scale / fs
+    # one-sided: double everything but DC (and Nyquist, if nfft is even)
+    psd[:, 1:(nfft + 1) // 2] *= 2.0
+    return (fft.rfftfreq(nfft, 1.0 / fs), psd)
+
+def welch_spectrum_batch(rr_series, sample_start=None, sample_length=None, fs=RESAMPLE_RATE, window_width=WELCH_WINDOW_WIDTH, overlap=WELCH_OVERLAP, points_per_hz=WELCH_POINTS_PER_HZ, detrend=detrending.smoothness_priors):
+    """Computes the Welch (FFT) spectrum of each of the RR interval series (ms) in rr_series.
+    Each series is resampled and detrended (see ar_spectrum_batch), and series of equal resampled length are
+    transformed together (see welch_psd). Series of different lengths can end up with different
+    frequency grids, so the result is a dict named after the fields of Res.HRV.Frequency.Welch
+    in the kubios output in which F and PSD are lists with one array per series, and
+    LF_power (ms^2) and LF_peak (Hz) are arrays.
+    See hrv.sample_window for sample_start and sample_length."""
+    tachograms = [resample_tachogram(rr, sample_start, sample_length, fs) for rr in rr_series]
+    result = {
+        'F': [None] * len(tachograms),
+        'PSD': [None] * len(tachograms),
+        'LF_power': np.empty(len(tachograms)),
+        'LF_peak': np.empty(len(tachograms))
+    }
+    lengths = np.array([len(x) for x in tachograms])
+    for n in np.unique(lengths):
+        rows = np.flatnonzero(lengths == n)
+        x = detrend(np.stack([tachograms[i] for i in rows]))
+        (freqs, psd) = welch_psd(x, fs, window_width, overlap, points_per_hz)
+        result['LF_power'][rows] = band_power(freqs, psd, LF_BAND)
+        result['LF_peak'][rows] = band_peak(freqs, psd, LF_BAND)[0]
+        for (i, row) in enumerate(rows):
+            result['F'][row] = freqs
+            result['PSD'][row] = psd[i]
+    return result
+
+def welch_spectrum(rr, sample_start=None, sample_length=None, fs=RESAMPLE_RATE, window_width=WELCH_WINDOW_WIDTH, overlap=WELCH_OVERLAP, points_per_hz=WELCH_POINTS_PER_HZ, detrend=detrending.smoothness_priors):
+    """Single-series version of welch_spectrum_batch"""
+    result = welch_spectrum_batch([rr], sample_start, sample_length, fs, window_width, overlap, points_per_hz, detrend)
+    return {k: v[0] for (k, v) in result.items()}
+
+def nearest_freq_index(freqs, target_freqs):
+    """Returns the index of the frequency in each row of freqs closest to the corresponding target_freqs
+    value. Use this rather than searching for an exact (floating point) match."""
+    freqs = np.atleast_2d(freqs)
+    target_freqs = np.reshape(target_freqs, (-1, 1))
+    return np.argmin(np.abs(freqs - target_freqs), axis=1)
+
+def has_multiple_peaks(psd, peak_idx, threshold=MULTI_PEAK_THRESHOLD):
+    """Given a 2d array of spectra (one per row) and the index of each one's peak, returns a boolean
+    array saying whether each spectrum has a second peak: a value >= threshold times the peak value
+    at or beyond the first value (going away from the peak) <= threshold times the peak value,
+    the gap. As in the check this replaced, a gap value exactly at the threshold counts as a second peak.
+    Both sides of the peak are searched. Every spectrum is classified at once."""
+    psd = np.atleast_2d(np.asarray(psd, dtype=np.float64))
+    peak_idx = np.reshape(peak_idx, (-1, 1))
+    (rows, n) = psd.shape
+    idx = np.arange(n)[None, :]
+    limit = threshold * np.take_along_axis(psd, peak_idx, axis=1)
+    below = psd <= limit
+    above = psd >= limit
+
+    # right of the peak: find the first gap, then look for anything at or above the limit
+    # from the gap on (so a gap value exactly at the limit counts too)
+    right_gaps = below & (idx > peak_idx)
+    first_right_gap = np.where(right_gaps.any(axis=1), np.argmax(right_gaps, axis=1), n)[:, None]
+    multi_right = (above & (idx >= first_right_gap)).any(axis=1)
+
+    # left of the peak: find the gap closest to the peak, then look for anything at or above the limit from it on
+    left_gaps = below & (idx < peak_idx)
+    last_left_gap = np.where(left_gaps.any(axis=1), n - 1 - np.argmax(left_gaps[:, ::-1], axis=1), -1)[:, None]
+    multi_left = (above & (idx <= last_left_gap)).any(axis=1)
+
+    return multi_right | multi_left
+
+def has_multiple_peaks_batch(freqs, psds, peak_freqs, threshold=MULTI_PEAK_THRESHOLD):
+    """Like has_multiple_peaks, but takes lists of frequency grids and spectra (which may differ
+    in length, e.g. when read from many kubios output files) and the peak frequency of each,
+    which is located with nearest_freq_index. Shorter spectra are zero-padded, which can't
+    create a second peak."""
+    n = max(len(p) for p in psds)
+    padded_psd = np.zeros((len(psds), n))
+    padded_freqs = np.full((len(psds), n), np.inf)
+    for (i, (f, p)) in enumerate(zip(freqs, psds)):
+        padded_psd[i, :len(p)] = p
+        padded_freqs[i, :len(f)] = f
+    peak_idx = nearest_freq_index(padded_freqs, peak_freqs)
+    return has_multiple_peaks(padded_psd, peak_idx, threshold)
@@ -0,0 +1,20 @@
+import artifacts
+import numpy as np
+
+def _steady_rr_with(factor, idx=100):
+    rr = 800.0 + 20.0 * np.sin(np.arange(200) / 5.0)
+    rr[idx] *= factor
+    return rr
+
+def test_drr_criterion_flags_isolated_long_and_short_beats(monkeypatch):
+    # take the mRR criterion out so that only the dRR (S22) criterion can flag the beat
+    monkeypatch.setattr(artifacts, 'LONG_SHORT_MRR_LIMIT', np.inf)
+    for factor in [1.5, 0.6]:
+        flags = artifacts.detect_artifacts(_steady_rr_with(factor))
+        flagged = np.flatnonzero(flags['long_short'] | flags['missed'] | flags['extra'])
+        assert flagged.tolist() == [100], 'beat scaled by {} flagged at {}'.format(factor, flagged)
+
+def test_isolated_long_and_short_beats_are_flagged():
+    for factor in [1.5, 0.6]:
+        flags = artifacts.detect_artifacts(_steady_rr_with(factor))
+        assert any(f[100] for f in flags.values())
@@ -0,0 +1,23 @@
+import coherence
+import numpy as np
+from types import SimpleNamespace
+
+def _breathing_rr(n=600, breaths_per_min=6.0):
+    # RR intervals modulated at the breathing rate, as in a very coherent session
+    t = np.cumsum(np.full(n, 0.85))
+    return 850.0 + 80.0 * np.sin(2 * np.pi * breaths_per_min / 60.0 * t)
+
+def test_compare_with_emwave_reports_only_sessions_that_differ():
+    rr = _breathing_rr()
+    native = coherence.CoherenceEngine().average(rr)
+    sessions = [
+        SimpleNamespace(rr_data=rr, avg_coherence=native),
+        SimpleNamespace(rr_data=rr, avg_coherence=native * 2),
+        SimpleNamespace(rr_data=rr, avg_coherence=None)
+    ]
+    assert coherence.compare_with_emwave(sessions) == [(1, native * 2, native)]
+
+def test_paced_breathing_is_more_coherent_than_noise():
+    engine = coherence.CoherenceEngine()
+    noisy = 850.0 + 40.0 * np.random.RandomState(0).standard_normal(600)
+    assert engine.average(_breathing_rr()) > engine.average(noisy)
@@ -0,0 +1,143 @@
+import detrending
+import hrv
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.interpolate import CubicSpline
+import spectrum
+
+# Default window length and step (s)
+WINDOW_LENGTH = 300
+WINDOW_STEP = 30
+
+def window_bounds(rr, window_length=WINDOW_LENGTH, step=WINDOW_STEP):
+    """Given RR intervals (ms), returns (starts, lo, hi): the start time (s) of each window
+    and the indices of its first beat and one past its last beat. Windows are window_length
+    seconds long, start step seconds apart at the first beat and only complete windows are
+    included. Beats are assigned to windows the same way hrv.sample_window does it."""
+    t = hrv.beat_times(rr)
+    if len(t) == 0 or t[-1] - t[0] < window_length:
+        empty = np.zeros(0, dtype=np.int64)
+        return (np.zeros(0), empty, empty)
+    num_windows = int((t[-1] - t[0] - window_length) // step) + 1
+    starts = t[0] + step * np.arange(num_windows)
+    lo = np.searchsorted(t, starts, side='left')
+    hi = np.searchsorted(t, starts + window_length, side='left')
+    return (starts, lo, hi)
+
+def _sparse_table(x, fn):
+    """Returns a list whose k-th element holds fn over every run of 2^k consecutive elements of x"""
+    table = [x]
+    width = 1
+    while 2 * width <= len(x):
+        prev = table[-1]
+        table.append(fn(prev[:-width], prev[width:]))
+        width *= 2
+    return table
+
+def _range_reduce(table, fn, lo, hi):
+    """Returns fn over x[lo:hi] for each (lo, hi) pair, where table is x's _sparse_table.
+    Each range is covered by two (possibly overlapping) runs of a power-of-two length,
+    so every query takes constant time."""
+    k = np.floor(np.log2(hi - lo)).astype(np.int64)
+    result = np.empty(len(lo))
+    for level in np.unique(k):
+        rows = np.flatnonzero(k == level)
+        run = table[level]
+        result[rows] = fn(run[lo[rows]], run[hi[rows] - (1 << level)])
+    return result
+
+def time_domain_windows(rr, window_length=WINDOW_LENGTH, step=WINDOW_STEP, min_max_beats=hrv.MIN_MAX_HR_BEATS):
+    """Returns a dict of the time-domain statistics (hrv.STAT_NAMES, in the units hrv.time_domain uses)
+    for every window (see window_bounds), plus 'start', the start time (s) of each window.
+    Sums over each window come from cumulative sums, and min/max HR from range queries over
+    a single moving average of the whole series, so the cost doesn't grow with the window length.
+    Windows with fewer than two beats get NaN."""
+    rr = np.asarray(rr, dtype=np.float64)
+    (starts, lo, hi) = window_bounds(rr, window_length, step)
+    stats = {name: np.full(len(starts), np.nan) for name in hrv.STAT_NAMES}
+    stats['start'] = starts
+    valid = (hi - lo) >= 2
+    if not valid.any():
+        return stats
+    lo = lo[valid]
+    hi = hi[valid]
+    n = hi - lo
+
+    def window_sums(x, lo, hi):
+        cumsum = np.concatenate(([0.0], np.cumsum(x)))
+        return cumsum[hi] - cumsum[lo]
+
+    # shift by the overall mean so that the sums of squares don't lose precision
+    offset = rr.mean()
+    shifted = rr - offset
+    sums = window_sums(shifted, lo, hi)
+    mean_rr = sums / n + offset
+    sdnn = np.sqrt(np.maximum(window_sums(shifted ** 2, lo, hi) - sums ** 2 / n, 0.0) / (n - 1))
+    # the successive differences within a window are diffs[lo:hi - 1]
+    rmssd = np.sqrt(window_sums(np.diff(rr) ** 2, lo, hi - 1) / (n - 1))
+
+    hr = 60000.0 / rr
+    mean_hr = window_sums(hr, lo, hi) / n
+
+    # moving_avg[j] is the mean HR of beats j to j + min_max_beats - 1; a window's min/max HR
+    # come from the moving averages that lie entirely within it. Windows shorter than that
+    # just use their mean HR, as hrv.time_domain_batch does.
+    min_hr = mean_hr.copy()
+    max_hr = mean_hr.copy()
+    if len(hr) >= min_max_beats:
+        moving_avg = window_sums(hr, np.arange(len(hr) - min_max_beats + 1), np.arange(min_max_beats, len(hr) + 1)) / min_max_beats
+        long_enough = n >= min_max_beats
+        ma_lo = lo[long_enough]
+        ma_hi = hi[long_enough] - min_max_beats + 1
+        min_hr[long_enough] = _range_reduce(_sparse_table(moving_avg, np.minimum), np.minimum, ma_lo, ma_hi)
+        max_hr[long_enough] = _range_reduce(_sparse_table(moving_avg, np.maximum), np.maximum, ma_lo, ma_hi)
+
+    for (name, values) in zip(hrv.STAT_NAMES, [mean_rr, sdnn, mean_hr, min_hr, max_hr, rmssd]):
+        stats[name][valid] = values
+    return stats
+
+def ar_spectrum_windows(rr, window_length=WINDOW_LENGTH, step=WINDOW_STEP, order=spectrum.AR_ORDER, fs=spectrum.RESAMPLE_RATE, n_freqs=spectrum.AR_FREQ_POINTS, detrend=detrending.smoothness_priors):
+    """Computes the AR spectrum of every window (see window_bounds). The whole series is resampled
+    once, every window is a strided view onto the resampled tachogram, and since the windows all
+    have the same length they are detrended and fit together (see spectrum.burg).
+    Returns a dict like spectrum.ar_spectrum_batch's (one PSD row per window), plus HF_power (ms^2)
+    and 'start', the start time (s) of each window."""
+    rr = np.asarray(rr, dtype=np.float64)
+    (starts, _, _) = window_bounds(rr, window_length, step)
+    freqs = np.linspace(0.0, fs / 2.0, n_freqs)
+    result = {'F': freqs, 'start': starts}
+    if len(starts) == 0:
+        result['PSD'] = np.zeros((0, n_freqs))
+        for name in ['LF_power', 'LF_peak', 'LF_peak_power', 'HF_power']:
+            result[name] = np.zeros(0)
+        return result
+
+    t = hrv.beat_times(rr)
+    tachogram = CubicSpline(t, rr)(np.arange(t[0], t[-1], 1.0 / fs))
+    window_samples = int(round(window_length * fs))
+    step_samples = int(round(step * fs))
+    windows = sliding_window_view(tachogram, window_samples)[::step_samples][:len(starts)]
+    # rounding can leave the last window a sample short of the end of the tachogram
+    starts = starts[:len(windows)]
+    result['start'] = starts
+    (a, noise_variance) = spectrum.burg(detrend(windows), order)
+    psd = spectrum.ar_psd(a, noise_variance, freqs, fs)
+
+    (lf_peak, lf_peak_power) = spectrum.band_peak(freqs, psd, spectrum.LF_BAND)
+    result['PSD'] = psd
+    result['LF_power'] = spectrum.band_power(freqs, psd, spectrum.LF_BAND)
+    result['LF_peak'] = lf_peak
+    result['LF_peak_power'] = lf_peak_power
+    result['HF_power'] = spectrum.band_power(freqs, psd, spectrum.HF_BAND)
+    return result
+
+def windowed_analysis(rr, window_length=WINDOW_LENGTH, step=WINDOW_STEP):
+    """Returns a dict of name -> array with one value per window (see window_bounds) of 'start' (s),
+    the time-domain statistics (see time_domain_windows) and the AR LF_power, LF_peak and HF_power
+    (see ar_spectrum_windows). Works on RR series of any length."""
+    analysis = time_domain_windows(rr, window_length, step)
+    ar = ar_spectrum_windows(rr, window_length, step)
+    analysis = {name: values[:len(ar['start'])] for (name, values) in analysis.items()}
+    for name in ['LF_power', 'LF_peak', 'HF_power']:
+        analysis[name] = ar[name]
+    return analysis
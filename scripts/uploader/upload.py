@@ -6,7 +6,11 @@ from botocore.exceptions import ClientError, EndpointConnectionError
 import conf
 import configparser
 import json
+import os
 from pathlib import Path
+import sqlite3
+import sys
+import tempfile
 import traceback
 
 region_name = "us-west-2"
@@ -41,6 +45,27 @@ def upload_file(file_path, bucket, key, secret, dest_name):
     response = client.upload_file(file_path, bucket, dest_name)
     return True
 
+def snapshot_db(db_path):
+    """Copies the sqlite database at db_path to a temporary file using sqlite's online backup API
+    and returns the path to the copy. The backup API produces a consistent copy even if the emWave
+    app has the database open, and the source is opened read-only so it can't be modified."""
+    (fd, snapshot_path) = tempfile.mkstemp(suffix='.emdb', prefix='emWave-snapshot.')
+    os.close(fd)
+    source = sqlite3.connect(Path(db_path).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        copy = sqlite3.connect(snapshot_path)
+        try:
+            source.backup(copy)
+        finally:
+            copy.close()
+    except BaseException:
+        # don't leave a partial copy behind
+        os.remove(snapshot_path)
+        raise
+    finally:
+        source.close()
+    return snapshot_path
+
 def get_subject_id():
     conf_file = Path.home() / 'AppData' / 'Roaming' / 'emWave_Pilot' / 'Info' / 'info.ini'
     if not conf_file.exists() or not conf_file.is_file():
@@ -59,10 +84,14 @@ if __name__ == "__main__":
             sys.exit(2)
         sid = get_subject_id()
         dest = sid + '/emWave.emdb'
-        if upload_file(str(emwave_db), secret['bucket'], secret['key'], secret['secret'], dest):
-            print('Upload successful')
-        else:
-            print('Upload failed')
+        snapshot = snapshot_db(str(emwave_db))
+        try:
+            if upload_file(snapshot, secret['bucket'], secret['key'], secret['secret'], dest):
+                print('Upload successful')
+            else:
+                print('Upload failed')
+        finally:
+            os.remove(snapshot)
     except EndpointConnectionError as e:
         print('No internet connection found. Please check your connection and try again.')
     except FileNotFoundError as fnf: